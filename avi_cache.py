@@ -0,0 +1,146 @@
+#############################################################################
+# Datamosh addon for blender                                                #
+# Copyright (C) 2025 Dan Argust                                             #
+#                                                                           #
+#    This program is free software: you can redistribute it and/or modify   #
+#    it under the terms of the GNU General Public License as published by   #
+#    the Free Software Foundation, either version 3 of the License, or      #
+#    (at your option) any later version.                                    #
+#                                                                           #
+#    This program is distributed in the hope that it will be useful,        #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of         #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the          #
+#    GNU General Public License for more details.                           #
+#                                                                           #
+#    You should have received a copy of the GNU General Public License      #
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>. #
+#############################################################################
+
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+DEFAULT_CACHE_DIR = os.path.join(tempfile.gettempdir(), "datamosh_cache")
+DEFAULT_BUDGET = 20 << 30
+
+# The content hash reads this many evenly spaced blocks of the input
+SAMPLE_COUNT = 16
+SAMPLE_SIZE = 1 << 16
+
+STALE_PARTIAL_AGE = 24 * 60 * 60
+
+def input_fingerprint(input_file):
+    """Size, mtime and a hash of sampled blocks, cheap even for huge renders."""
+    stat = os.stat(input_file)
+    digest = hashlib.sha1()
+    with open(input_file, "rb") as f:
+        step = max(stat.st_size // SAMPLE_COUNT, 1)
+        for offset in range(0, stat.st_size, step)[:SAMPLE_COUNT]:
+            f.seek(offset)
+            digest.update(f.read(SAMPLE_SIZE))
+        f.seek(max(stat.st_size - SAMPLE_SIZE, 0))
+        digest.update(f.read(SAMPLE_SIZE))
+    return [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+
+def cache_key(input_file, **settings):
+    """Key for the conversion of input_file with the given ffmpeg settings."""
+    identity = {"input": input_fingerprint(input_file), "settings": settings}
+    return hashlib.sha1(json.dumps(identity, sort_keys=True).encode()).hexdigest()
+
+class ConversionCache:
+    """Directory of converted AVIs keyed by cache_key, evicted least recently used first.
+
+    Entries are <key>.avi plus any sidecar files named <key>.avi.*, such as
+    the cached mosh plan. Use is recorded in the access time of the AVI so
+    its mtime, which the sidecars validate against, never changes.
+    """
+
+    def __init__(self, directory=None, budget=DEFAULT_BUDGET):
+        self.directory = directory or DEFAULT_CACHE_DIR
+        self.budget = budget
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".avi")
+
+    def partial_path(self, key):
+        """Where to convert to before store(), in the cache directory so the final rename is atomic."""
+        return os.path.join(self.directory, f"{key}.{os.getpid()}.partial.avi")
+
+    def lookup(self, key):
+        path = self.path(key)
+        try:
+            self._touch(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def store(self, key, filename):
+        path = self.path(key)
+        os.replace(filename, path)
+        self._touch(path)
+        self.evict(keep=path)
+        return path
+
+    def entries(self):
+        """(last use, total size, files) of every entry, oldest first.
+
+        Other processes sharing the cache may remove or rename files while
+        it is listed, those are left out.
+        """
+        groups = {}
+        for name in os.listdir(self.directory):
+            if name.endswith(".partial.avi"):
+                continue
+            key = name.split(".", 1)[0]
+            groups.setdefault(key, []).append(os.path.join(self.directory, name))
+        entries = []
+        for key, files in groups.items():
+            avi = self.path(key)
+            if avi not in files:
+                continue
+            try:
+                last_used = os.stat(avi).st_atime_ns
+            except FileNotFoundError:
+                continue
+            sizes = {}
+            for filename in files:
+                try:
+                    sizes[filename] = os.path.getsize(filename)
+                except FileNotFoundError:
+                    pass
+            entries.append((last_used, sum(sizes.values()), list(sizes)))
+        return sorted(entries)
+
+    def evict(self, keep=None):
+        # Conversions that were interrupted without cleaning up after themselves
+        for name in os.listdir(self.directory):
+            if not name.endswith(".partial.avi"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                if time.time() - os.path.getmtime(path) > STALE_PARTIAL_AGE:
+                    os.remove(path)
+            except FileNotFoundError:
+                # Stored or removed by another process meanwhile
+                pass
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for last_used, size, files in entries:
+            if total <= self.budget:
+                break
+            if keep in files:
+                continue
+            print(f"Evicting cached conversion: {min(files, key=len)}")
+            for filename in files:
+                try:
+                    os.remove(filename)
+                except OSError:
+                    pass
+            total -= size
+
+    def _touch(self, path):
+        stat = os.stat(path)
+        os.utime(path, ns=(time.time_ns(), stat.st_mtime_ns))
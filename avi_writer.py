@@ -0,0 +1,437 @@
+#############################################################################
+# Datamosh addon for blender                                                #
+# Copyright (C) 2025 Dan Argust                                             #
+#                                                                           #
+#    This program is free software: you can redistribute it and/or modify   #
+#    it under the terms of the GNU General Public License as published by   #
+#    the Free Software Foundation, either version 3 of the License, or      #
+#    (at your option) any later version.                                    #
+#                                                                           #
+#    This program is distributed in the hope that it will be useful,        #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of         #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the          #
+#    GNU General Public License for more details.                           #
+#                                                                           #
+#    You should have received a copy of the GNU General Public License      #
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>. #
+#############################################################################
+
+from bisect import bisect_right
+import os
+import struct
+import time
+try:
+    from .riff import walk_chunks
+except ImportError:
+    from riff import walk_chunks
+
+AVIIF_KEYFRAME = 0x10
+
+# avih flag telling players the index, not the order of the movi chunks, gives the frame order
+AVIF_MUSTUSEINDEX = 0x20
+
+# OpenDML index types and the bit set in a standard index entry's size for a non-keyframe
+AVI_INDEX_OF_INDEXES = 0x00
+AVI_INDEX_OF_CHUNKS = 0x01
+ODML_NOT_KEYFRAME = 0x80000000
+
+# A new 'RIFF AVIX' segment is started before the current one grows past
+# this, the 1 GiB ffmpeg and most readers expect of OpenDML files
+RIFF_LIMIT = 1 << 30
+
+# Without room for a super index the output stays a single AVI 1.0 RIFF,
+# whose size field is 32-bit
+AVI1_LIMIT = 1 << 32
+
+# Spans are copied in blocks of this size so progress can be reported in between
+COPY_BLOCK = 64 << 20
+
+class AviWriter:
+    """Streams a rewritten AVI to disk one chunk at a time.
+
+    The headers and the start of the movi list are copied verbatim from the
+    source index, frames are appended as they are decided, and finish()
+    writes a fresh idx1 and back-patches the RIFF/movi sizes and the frame
+    counts in avih, strh and dmlh. Only the index entries are held in memory.
+
+    Output that grows past riff_limit becomes an OpenDML (AVI 2.0) file:
+    further frames go into 'RIFF AVIX' segments, each movi list gets an
+    ix00 standard index, the indx super index is written over the space
+    reserved for it in the video strl, and idx1 covers the first RIFF only.
+    Sources without such a slot give a plain AVI of up to 4 GiB instead,
+    growing past that raises ValueError.
+
+    alias_frame() indexes a frame that was already written a second time
+    without storing it again, the file is then flagged AVIF_MUSTUSEINDEX.
+    Players that read the movi list in order rather than through the index
+    show such a frame only once.
+
+    checkpoint() makes the file written so far a playable AVI on its own;
+    with checkpoint_interval set that happens every so many seconds while
+    frames are written, calling on_checkpoint with the frame count after
+    each one, so the output can be watched while it grows. The next frames
+    are written over the interim index, so whatever reads the file has to
+    have opened it before on_checkpoint returns.
+
+    With reuse_existing the writer starts in a dry run over an existing
+    output file: chunks are indexed but not written until resume() is
+    called, which keeps the bytes already on disk up to that point.
+    """
+
+    def __init__(self, output_filename, index, reuse_existing=False, riff_limit=None):
+        self.filename = output_filename
+        self.index = index
+        # Called with the current source offset while copying, may raise to abort
+        self.progress = None
+        self.checkpoint_interval = None
+        self.on_checkpoint = None
+        self.checkpoints = 0
+        self._last_checkpoint = time.monotonic()
+        self.frame_count = 0
+        self.aliased_count = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.reusing = reuse_existing and os.path.exists(output_filename)
+        # idx1 entries of the first RIFF and ix00 entries of the current movi list
+        self._entries = bytearray()
+        self._segment_entries = bytearray()
+        # (offset, size, frame count) of the ix00 chunk of every finished movi list
+        self._segments = []
+        self._first_riff_frames = None
+        self._kernel_copy = True
+        self._f = open(output_filename, "r+b" if self.reusing else "wb")
+        self._pos = 0
+
+        self._riff_start = index["riff"]["start"]
+        self.movi_start = index["movi"]["start"]
+        self._avih_flags_offset = index["hdrl"]["avih"]["start"] + 8 + 12  # dwFlags
+        self._avih_frames_offset = index["hdrl"]["avih"]["start"] + 8 + 16  # dwTotalFrames
+        self._patch_offsets = [
+            index["hdrl"]["strh"]["start"] + 8 + 32,  # dwLength
+        ]
+        if index["hdrl"].get("dmlh"):
+            self._patch_offsets.append(index["hdrl"]["dmlh"]["start"] + 8)  # dwTotalFrames
+        self._super_index_slot = _super_index_slot(index)
+        # Segments past the first are only readable through the super index
+        self._max_segments = (self._super_index_slot[1] - 24) // 16 if self._super_index_slot else 1
+        self.riff_limit = (riff_limit or RIFF_LIMIT) if self._max_segments > 1 else AVI1_LIMIT
+        # Everything up to the first frame (RIFF, hdrl and the movi list header) is unchanged
+        self.copy_span(self._riff_start, index.frame_span(0)[0])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.finish()
+        else:
+            self.abort()
+
+    @property
+    def position(self):
+        return self._pos
+
+    def resume(self):
+        """Stop reusing the existing output and write from the current position on."""
+        self.reusing = False
+        self._f.seek(self._pos)
+        self._f.truncate()
+
+    def write(self, data):
+        if self.reusing:
+            self._pos += len(data)
+            return
+        self._f.write(data)
+        self._pos += len(data)
+        self.bytes_written += len(data)
+
+    def write_frame(self, i, flags=0, source=None, data=None):
+        """Append source frame i (with its padding) and index it.
+
+        source defaults to the index the writer was created from, any other
+        AviIndex with the same stream layout can be given instead. data is
+        the frame's span if the caller has already read it. Returns the
+        position the frame was written at.
+        """
+        source = source or self.index
+        if data is None:
+            start, end = source.frame_span(i)
+            data = source.view(start, end)
+            if not self.reusing:
+                self.bytes_read += end - start
+        if len(data) > self._room() and self._segment_entries:
+            self._roll()
+        position = self._pos
+        self._add_entry(source, i, position, flags)
+        self.write(data)
+        self._maybe_checkpoint()
+        return position
+
+    def alias_frame(self, i, position, flags=0, source=None):
+        """Index source frame i again at position, where write_frame() just put it.
+
+        Nothing is written. The frame must be in the current RIFF segment,
+        which holds as long as no other frame was written in between.
+        """
+        self._add_entry(source or self.index, i, position, flags)
+        self.aliased_count += 1
+
+    def copy_frames(self, first, last, source=None, chunk=None):
+        """Copy the source frames first..last-1 unchanged, keeping their index flags.
+
+        Contiguous frames are copied as one span, split only where the
+        source moves to another RIFF segment or the output has to. chunk is
+        an optional (source offset, buffer) already read by the caller that
+        covers the frames, written out instead of copying from the file.
+        """
+        source = source or self.index
+        starts = source.frames.starts
+        flags = source.frames.flags
+        i = first
+        while i < last:
+            segment_end = source.segment_end(i)
+            run_end = min(last, segment_end)
+            start = starts[i]
+            # Frames end where the next one starts, so the run that still fits
+            # in this RIFF ends at the last start within the room left
+            limit = start + self._room()
+            j = bisect_right(starts, limit, i + 1, run_end) - 1
+            if j == run_end - 1 and source.frame_span(j)[1] <= limit:
+                j = run_end
+            if j == i:
+                if self._segment_entries:
+                    self._roll()
+                    continue
+                # A frame bigger than a whole segment still has to go somewhere
+                j = i + 1
+            if self.checkpoint_interval is not None:
+                # Stop at a frame boundary now and then so long runs can be checkpointed
+                j = min(j, max(bisect_right(starts, start + COPY_BLOCK, i + 1, j) - 1, i + 1))
+            end = source.frame_span(j - 1)[1]
+            shift = self._pos - start
+            for k in range(i, j):
+                self._add_entry(source, k, starts[k] + shift, flags[k])
+            if chunk is None:
+                self.copy_span(start, end, source)
+            else:
+                self.write(chunk[1][start - chunk[0]:end - chunk[0]])
+            self._maybe_checkpoint()
+            i = j
+
+    def copy_span(self, start, end, source=None):
+        """Copy source bytes start..end, kernel-side where the platform allows it."""
+        source = source or self.index
+        count = end - start
+        if count <= 0:
+            return
+        if self.reusing:
+            self._pos += count
+            return
+        self.bytes_read += count
+        while count > 0:
+            block = min(count, COPY_BLOCK)
+            copied = 0
+            if self._kernel_copy:
+                self._f.flush()
+                try:
+                    copied = _kernel_copy(source.fileno(), self._f.fileno(), start, block, self._pos)
+                except OSError:
+                    # e.g. EXDEV/EINVAL on some filesystems, fall back for the rest of the file
+                    self._kernel_copy = False
+                if copied:
+                    self._pos += copied
+                    self.bytes_written += copied
+                    self._f.seek(self._pos)
+                else:
+                    self._kernel_copy = False
+            if copied < block:
+                self.write(source.view(start + copied, start + block))
+            start += block
+            count -= block
+            if self.progress:
+                self.progress(start)
+
+    def checkpoint(self):
+        """Make the file on disk a playable AVI of the frames written so far.
+
+        The index, sizes and frame counts are written as if the file ended
+        here and flushed, then writing carries on from the same position over
+        the interim index, the file is only playable until then. Returns False if there was nothing to do (nothing
+        written yet, or still reusing an existing output).
+        """
+        if self.reusing or not self._segment_entries:
+            return False
+        end = self._pos
+        if self._segments:
+            segment = self._write_standard_index()
+            self._patch(self.movi_start - 4, self._pos - self.movi_start)
+            self._patch(self._riff_start + 4, self._pos - self._riff_start - 8)
+            self._write_super_index(self._segments + [segment])
+            first_riff_frames = self._first_riff_frames
+        else:
+            self._patch(self.movi_start - 4, self._pos - self.movi_start)
+            self._write_idx1()
+            self._patch(self._riff_start + 4, self._pos - self._riff_start - 8)
+            self._hide_source_indx()
+            first_riff_frames = self.frame_count
+        self._patch_frame_counts(first_riff_frames)
+        self._f.flush()
+        self._f.seek(end)
+        self._pos = end
+        self.checkpoints += 1
+        return True
+
+    def _maybe_checkpoint(self):
+        if self.checkpoint_interval is None or time.monotonic() - self._last_checkpoint < self.checkpoint_interval:
+            return
+        self._last_checkpoint = time.monotonic()
+        if self.checkpoint() and self.on_checkpoint:
+            self.on_checkpoint(self.frame_count)
+
+    def finish(self):
+        if self.reusing:
+            self.resume()
+        if self._segments:
+            self._close_segment()
+            self._write_super_index(self._segments)
+        else:
+            self._patch(self.movi_start - 4, self._pos - self.movi_start)
+            self._write_idx1()
+            # Keep anything the source had after its index, within its first RIFF
+            source_riff = self.index["riffs"][0]
+            if self.index["idx1"]["end"] is not None:
+                self.copy_span(self.index["idx1"]["end"], min(source_riff["start"] + 8 + source_riff["size"], len(self.index.data)))
+            if self._pos - self._riff_start - 8 > 0xFFFFFFFF:
+                raise ValueError(f"{self.filename} is too big for a single RIFF and there is no room for the OpenDML super index it would need")
+            self._patch(self._riff_start + 4, self._pos - self._riff_start - 8)
+            self._first_riff_frames = self.frame_count
+            self._hide_source_indx()
+        self._patch_frame_counts(self._first_riff_frames)
+        # A checkpoint's interim index may have run past the final end
+        self._f.truncate()
+        self._f.close()
+
+    def abort(self):
+        self._f.close()
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+    def _room(self):
+        """Bytes left before the current RIFF segment reaches riff_limit."""
+        room = self._riff_start + self.riff_limit - self._pos
+        if self._max_segments == 1:
+            # The idx1 has to fit in the same RIFF
+            room -= 8 + len(self._entries)
+        return room
+
+    def _roll(self):
+        """Close the current RIFF segment and open a 'RIFF AVIX' one with its own movi list."""
+        # The last segment is added to the super index by finish()
+        if len(self._segments) + 2 > self._max_segments:
+            raise ValueError(f"{self.filename} is too big for a single RIFF and there is no room for the OpenDML super index it would need")
+        self._close_segment()
+        self._riff_start = self._pos
+        self.write(b"RIFF" + bytes(4) + b"AVIX" + b"LIST" + bytes(4) + b"movi")
+        self.movi_start = self._pos - 4
+
+    def _close_segment(self):
+        self._segments.append(self._write_standard_index())
+        self._segment_entries = bytearray()
+        self._patch(self.movi_start - 4, self._pos - self.movi_start)
+        if len(self._segments) == 1:
+            # Legacy readers still get an idx1 for the first RIFF
+            self._first_riff_frames = self.frame_count
+            self._write_idx1()
+            self._entries = bytearray()
+        self._patch(self._riff_start + 4, self._pos - self._riff_start - 8)
+
+    def _write_standard_index(self):
+        """Write the ix00 of the current movi list at its end, returns its (offset, size, frame count)."""
+        ix_start = self._pos
+        count = len(self._segment_entries) // 8
+        self.write(struct.pack("<4sIHBBI4sQI", b"ix00", 24 + len(self._segment_entries), 2, 0, AVI_INDEX_OF_CHUNKS, count, b"00dc", self.movi_start, 0))
+        self.write(self._segment_entries)
+        return ix_start, self._pos - ix_start, count
+
+    def _write_idx1(self):
+        self.write(b"idx1")
+        self.write(struct.pack("<I", len(self._entries)))
+        self.write(self._entries)
+
+    def _write_super_index(self, segments):
+        """Write the indx over its slot in the strl, False if there is no room for it."""
+        slot = self._super_index_slot
+        if slot is None or (slot[1] - 24) // 16 < len(segments):
+            return False
+        offset, size, _ = slot
+        indx = struct.pack("<4sIHBBI4s12x", b"indx", size, 4, 0, AVI_INDEX_OF_INDEXES, len(segments), b"00dc")
+        indx += b"".join(struct.pack("<QII", *segment) for segment in segments)
+        self._patch_bytes(offset, indx + bytes(size + 8 - len(indx)))
+        return True
+
+    def _hide_source_indx(self):
+        # The indx of an OpenDML source points at its own standard indexes
+        if self._super_index_slot is not None and self._super_index_slot[2]:
+            self._patch_bytes(self._super_index_slot[0], b"JUNK")
+
+    def _patch_frame_counts(self, first_riff_frames):
+        self._patch(self._avih_frames_offset, first_riff_frames)
+        # Always written, a reused output may carry the flag of an earlier aliased run
+        avih_flags = struct.unpack_from("<I", self.index.data, self._avih_flags_offset)[0] & ~AVIF_MUSTUSEINDEX
+        self._patch(self._avih_flags_offset, avih_flags | AVIF_MUSTUSEINDEX if self.aliased_count else avih_flags)
+        for offset in self._patch_offsets:
+            self._patch(offset, self.frame_count)
+
+    def _add_entry(self, source, i, position, flags):
+        size = source.frames.sizes[i]
+        if not self._segments:
+            self._entries += source.frame_view(i)[0:4]
+            self._entries += struct.pack("<III", flags, position - self.movi_start, size)
+        # Standard index offsets point at the frame data, relative to the movi list
+        self._segment_entries += struct.pack("<II", position + 8 - self.movi_start, size if flags & AVIIF_KEYFRAME else size | ODML_NOT_KEYFRAME)
+        self.frame_count += 1
+
+    def _patch(self, offset, value):
+        self._patch_bytes(offset, struct.pack("<I", value))
+
+    def _patch_bytes(self, offset, data):
+        self._f.seek(offset)
+        self._f.write(data)
+        self._f.seek(self._pos)
+
+def _super_index_slot(index):
+    """(offset, size, is_indx) of the video strl chunk the indx super index can go in.
+
+    That is the indx of an OpenDML source, or the JUNK chunk ffmpeg
+    reserves for it. None if the strl has neither.
+    """
+    strl = index["hdrl"]["strl"]
+    slot = None
+    for chunk in walk_chunks(index.data, strl["start"] + 4, strl["start"] + strl["size"], max_depth=0):
+        if chunk.fourcc == b"indx":
+            return chunk.start, chunk.size, True
+        if chunk.fourcc == b"JUNK" and slot is None:
+            slot = (chunk.start, chunk.size, False)
+    return slot
+
+def _kernel_copy(src_fd, dst_fd, offset, count, dst_offset):
+    """Copy count bytes between files without passing them through Python.
+
+    Returns the number of bytes copied, which is 0 when neither
+    copy_file_range nor sendfile is available.
+    """
+    copied = 0
+    if hasattr(os, "copy_file_range"):
+        while copied < count:
+            n = os.copy_file_range(src_fd, dst_fd, count - copied, offset + copied, dst_offset + copied)
+            if n == 0:
+                break
+            copied += n
+    elif hasattr(os, "sendfile") and os.name != "nt":
+        os.lseek(dst_fd, dst_offset, os.SEEK_SET)
+        while copied < count:
+            n = os.sendfile(dst_fd, src_fd, offset + copied, count - copied)
+            if n == 0:
+                break
+            copied += n
+    return copied
@@ -0,0 +1,266 @@
+#############################################################################
+# Datamosh addon for blender                                                #
+# Copyright (C) 2025 Dan Argust                                             #
+#                                                                           #
+#    This program is free software: you can redistribute it and/or modify   #
+#    it under the terms of the GNU General Public License as published by   #
+#    the Free Software Foundation, either version 3 of the License, or      #
+#    (at your option) any later version.                                    #
+#                                                                           #
+#    This program is distributed in the hope that it will be useful,        #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of         #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the          #
+#    GNU General Public License for more details.                           #
+#                                                                           #
+#    You should have received a copy of the GNU General Public License      #
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>. #
+#############################################################################
+
+
+"""Run datamosh jobs from a JSON manifest, without Blender.
+
+    python batch.py manifest.json --processes 8
+
+The manifest lists the jobs, each naming an input render and the frames to
+mosh; "defaults" applies to every job. Paths are relative to the manifest.
+
+    {
+        "defaults": {"compression": 3, "duplicated_p_frames": 0},
+        "jobs": [
+            {"name": "shot010", "input": "renders/shot010.mp4", "transition_frames": [153, 285]},
+            {"name": "shot010_long", "input": "renders/shot010.mp4", "output": "out/shot010_long.avi",
+             "transition_frames": [153, 285], "start_points": [143, 275], "end_points": [400, 500]}
+        ]
+    }
+
+Without start_points/end_points each transition is moshed from 10 frames
+before to 60 after, like Get Start Frames; when only one is given the
+other is filled in for every transition. "transition_frames": "auto"
+detects the scene cuts of the converted input instead. Every input is converted once for
+all of its jobs, then the jobs run concurrently. Each job gets a log and a
+JSON report in the log directory, the exit status is 0 if every job
+succeeded and 1 otherwise.
+"""
+
+import os
+import sys
+# Run as a script the addon directory comes first on sys.path, where
+# operator.py would shadow the stdlib module, so move it to the end first
+if sys.path and os.path.abspath(sys.path[0] or os.curdir) == os.path.dirname(os.path.abspath(__file__)):
+    sys.path.append(sys.path.pop(0))
+
+import argparse
+import contextlib
+import json
+import traceback
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+try:
+    from .parse_raw_avi import convert_to_avi, extract_avi_data, sidecar_path
+    from .mosh_plan import parse_frame_list, plan_cache_files
+    from .avi_cache import ConversionCache, cache_key
+    from .pipeline import DatamoshJob
+    from .scene_cuts import detect_scene_cuts, propose_mosh_points
+except ImportError:
+    from parse_raw_avi import convert_to_avi, extract_avi_data, sidecar_path
+    from mosh_plan import parse_frame_list, plan_cache_files
+    from avi_cache import ConversionCache, cache_key
+    from pipeline import DatamoshJob
+    from scene_cuts import detect_scene_cuts, propose_mosh_points
+
+JOB_DEFAULTS = {"compression": 3, "duplicated_p_frames": 0, "alias_duplicates": False, "convert_workers": 1, "transition_frames": [], "start_points": None, "end_points": None, "output": None}
+
+def frame_list(value):
+    return parse_frame_list(value) if isinstance(value, str) else [int(frame) for frame in value]
+
+def fill_windows(job, transitions, frame_count=None):
+    """The job's transitions, start and end points, proposing the points it leaves out.
+
+    Transitions too close to the start for a lead-in are skipped only when
+    both are proposed; explicit points pair up with every transition.
+    """
+    start_points, end_points = job["start_points"], job["end_points"]
+    if start_points is None and end_points is None:
+        kept, start_points, end_points = propose_mosh_points(transitions, frame_count)
+        skipped = [frame for frame in transitions if frame not in kept]
+        if skipped:
+            print(f"Job {job['name']}: skipping transitions {skipped}, too close to the start to mosh")
+        return kept, start_points, end_points
+    _, proposed_starts, proposed_ends = propose_mosh_points(transitions, frame_count, skip_early=False)
+    start_points = proposed_starts if start_points is None else frame_list(start_points)
+    end_points = proposed_ends if end_points is None else frame_list(end_points)
+    return transitions, start_points, end_points
+
+def load_manifest(filename):
+    """The manifest's jobs with defaults applied, paths made absolute and windows filled in."""
+    with open(filename) as f:
+        manifest = json.load(f)
+    base = os.path.dirname(os.path.abspath(filename))
+    defaults = dict(JOB_DEFAULTS, **manifest.get("defaults", {}))
+    jobs = []
+    for k, entry in enumerate(manifest["jobs"]):
+        job = dict(defaults, **entry)
+        job["input"] = os.path.join(base, job["input"])
+        job.setdefault("name", f"{k:03d}_{os.path.splitext(os.path.basename(job['input']))[0]}")
+        if job["output"] is None:
+            job["output"] = os.path.splitext(job["input"])[0] + f"_{job['name']}_glitched.avi"
+        job["output"] = os.path.join(base, job["output"])
+        jobs.append(job)
+        if job["transition_frames"] == "auto":
+            # Filled in by run_job once the input is converted
+            continue
+        job["transition_frames"], job["start_points"], job["end_points"] = fill_windows(job, frame_list(job["transition_frames"]))
+        if len(job["start_points"]) != len(job["end_points"]):
+            raise ValueError(f"Job {job['name']}: start_points and end_points differ in length")
+    for key in ("name", "output"):
+        values = [job[key] for job in jobs]
+        duplicates = sorted({value for value in values if values.count(value) > 1})
+        if duplicates:
+            raise ValueError(f"Jobs share the same {key}: {', '.join(duplicates)}")
+    return jobs
+
+@contextlib.contextmanager
+def job_log(log_file):
+    """Send everything printed meanwhile, by Python and by ffmpeg, to log_file."""
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = [os.dup(1), os.dup(2)]
+    with open(log_file, "w") as log:
+        os.dup2(log.fileno(), 1)
+        os.dup2(log.fileno(), 2)
+        try:
+            yield
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(saved[0], 1)
+            os.dup2(saved[1], 2)
+            for fd in saved:
+                os.close(fd)
+
+def convert_input(input_file, compression, workers, cache_dir, log_file):
+    """Pool task: convert one input for all of its jobs and index it, returning the AVI."""
+    with job_log(log_file):
+        try:
+            return _convert_input(input_file, compression, workers, cache_dir)
+        except Exception:
+            traceback.print_exc()
+            raise
+
+def _convert_input(input_file, compression, workers, cache_dir):
+    if input_file.lower().endswith(".avi"):
+        avi_file = input_file
+    elif cache_dir:
+        cache = ConversionCache(cache_dir)
+        # Same key as DatamoshJob, so Blender and batch runs share conversions
+        key = cache_key(input_file, compression=compression, start_frame=0, frame_count=None)
+        avi_file = cache.lookup(key)
+        if avi_file is None:
+            partial = cache.partial_path(key)
+            convert_to_avi(input_file, partial, compression, workers=workers)
+            avi_file = cache.store(key, partial)
+        else:
+            print(f"Using cached conversion: {avi_file}")
+    else:
+        avi_file = os.path.splitext(input_file)[0] + f"_temp_q{compression}.avi"
+        convert_to_avi(input_file, avi_file, compression, workers=workers)
+    # Leaves the index sidecar behind, so the jobs don't each parse the file
+    extract_avi_data(avi_file).close()
+    return avi_file
+
+def run_job(job, avi_file, log_file, report_file):
+    """Pool task: mosh one job from its converted AVI, returning the job's final message."""
+    with job_log(log_file):
+        print(f"Job {job['name']}: {job['input']} -> {job['output']}")
+        if job["transition_frames"] == "auto":
+            with extract_avi_data(avi_file) as index:
+                cuts = detect_scene_cuts(index.frames)
+                frame_count = index.frame_count
+            print(f"Detected {len(cuts)} scene cuts: {cuts}")
+            job = dict(job)
+            job["transition_frames"], job["start_points"], job["end_points"] = fill_windows(job, cuts, frame_count)
+        datamosh = DatamoshJob(avi_file, job["output"], job["start_points"], job["end_points"], job["transition_frames"], job["duplicated_p_frames"], report_file=report_file, alias_duplicates=job["alias_duplicates"])
+        datamosh.run()
+        return datamosh.poll()[-1]
+
+def remove_conversion(avi_file):
+    for filename in [avi_file, sidecar_path(avi_file)] + plan_cache_files(avi_file):
+        if os.path.exists(filename):
+            os.remove(filename)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run datamosh jobs from a JSON manifest.")
+    parser.add_argument("manifest", help="JSON job manifest")
+    parser.add_argument("--processes", type=int, default=0, help="jobs run at once, 0 uses one per CPU")
+    parser.add_argument("--log-dir", help="where job logs and reports go, default datamosh_logs next to the manifest")
+    parser.add_argument("--cache-dir", help="keep conversions in this ConversionCache instead of deleting them")
+    parser.add_argument("--summary", help="write the status of every job to this JSON file")
+    args = parser.parse_args(argv)
+
+    try:
+        jobs = load_manifest(args.manifest)
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Invalid manifest {args.manifest}: {e}", file=sys.stderr)
+        return 2
+    log_dir = args.log_dir or os.path.join(os.path.dirname(os.path.abspath(args.manifest)), "datamosh_logs")
+    os.makedirs(log_dir, exist_ok=True)
+
+    # Jobs that need the same conversion share it
+    conversions = {}
+    for job in jobs:
+        conversions.setdefault((job["input"], job["compression"]), []).append(job)
+    results = {}
+
+    with ProcessPoolExecutor(args.processes or os.cpu_count() or 1) as pool:
+        pending = {}
+        for k, ((input_file, compression), input_jobs) in enumerate(conversions.items()):
+            log_file = os.path.join(log_dir, f"convert_{k:03d}_{os.path.basename(input_file)}.log")
+            workers = max(job["convert_workers"] for job in input_jobs)
+            future = pool.submit(convert_input, input_file, compression, workers, args.cache_dir, log_file)
+            pending[future] = ("convert", (input_file, compression), log_file)
+        remaining = {key: len(input_jobs) for key, input_jobs in conversions.items()}
+        converted = {}
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                kind, target, log_file = pending.pop(future)
+                if kind == "convert":
+                    try:
+                        converted[target] = future.result()
+                    except Exception as e:
+                        print(f"Conversion of {target[0]} failed: {e} (see {log_file})", file=sys.stderr)
+                        for job in conversions[target]:
+                            results[job["name"]] = {"exit_code": 1, "error": f"conversion failed: {e}", "log": log_file}
+                        continue
+                    for job in conversions[target]:
+                        job_log_file = os.path.join(log_dir, f"{job['name']}.log")
+                        report_file = os.path.join(log_dir, f"{job['name']}_report.json")
+                        future = pool.submit(run_job, job, converted[target], job_log_file, report_file)
+                        pending[future] = ("job", job, job_log_file)
+                    continue
+
+                job = target
+                try:
+                    message, *payload = future.result()
+                except Exception as e:
+                    message, payload = "error", [str(e)]
+                if message == "done":
+                    results[job["name"]] = {"exit_code": 0, "outputs": [output for output, _ in payload[0]], "log": log_file}
+                    print(f"{job['name']}: done -> {job['output']}")
+                else:
+                    results[job["name"]] = {"exit_code": 1, "error": payload[0], "log": log_file}
+                    print(f"{job['name']}: failed: {payload[0]} (see {log_file})", file=sys.stderr)
+                key = (job["input"], job["compression"])
+                remaining[key] -= 1
+                if remaining[key] == 0 and not args.cache_dir and converted[key] != job["input"]:
+                    remove_conversion(converted[key])
+
+    failed = sum(1 for result in results.values() if result["exit_code"])
+    print(f"{len(jobs) - failed} of {len(jobs)} jobs succeeded, logs in {log_dir}")
+    if args.summary:
+        with open(args.summary, "w") as f:
+            json.dump({name: results[name] for name in (job["name"] for job in jobs)}, f, indent=2)
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
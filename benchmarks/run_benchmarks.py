@@ -0,0 +1,149 @@
+#############################################################################
+# Datamosh addon for blender                                                #
+# Copyright (C) 2025 Dan Argust                                             #
+#                                                                           #
+#    This program is free software: you can redistribute it and/or modify   #
+#    it under the terms of the GNU General Public License as published by   #
+#    the Free Software Foundation, either version 3 of the License, or      #
+#    (at your option) any later version.                                    #
+#                                                                           #
+#    This program is distributed in the hope that it will be useful,        #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of         #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the          #
+#    GNU General Public License for more details.                           #
+#                                                                           #
+#    You should have received a copy of the GNU General Public License      #
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>. #
+#############################################################################
+
+"""Time the parse and mosh steps on synthetic AVIs and print the results as JSON.
+
+    python benchmarks/run_benchmarks.py --frames 1000 10000 100000 --windows 4 --output results.json
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# Appended rather than prepended: the addon's operator.py would shadow the stdlib module
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from parse_raw_avi import extract_avi_data, collect_frame_flags, create_datamoshed_avi, create_datamoshed_avis, sidecar_path
+from mosh_plan import plan_cache_path, plan_cache_files
+from instrumentation import max_rss
+from synthetic_avi import write_synthetic_avi
+
+DEFAULT_WORKDIR = os.path.join(tempfile.gettempdir(), "datamosh_bench")
+
+def mosh_windows(frame_count, window_count):
+    """Evenly spread windows covering half the file, with a transition 10 frames in like get_start_frames."""
+    slot = frame_count // window_count
+    start_at = [k * slot + slot // 4 for k in range(window_count)]
+    end_at = [start + slot // 2 for start in start_at]
+    return start_at, end_at, [start + 10 for start in start_at]
+
+def measure(func, repeat, setup=None):
+    """Best and median wall time over repeat runs, then one traced run for the peak allocation."""
+    times = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            started = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - started)
+    if setup:
+        setup()
+    tracemalloc.start()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {"best": min(times), "median": statistics.median(times), "peak_alloc": peak}
+
+def remove(filename):
+    if os.path.exists(filename):
+        os.remove(filename)
+
+def run_case(args, frame_count, window_count):
+    name = f"synthetic_{frame_count}_gop{args.gop}_i{args.i_size}_p{args.p_size}.avi"
+    input_file = os.path.join(args.workdir, name)
+    output_file = os.path.join(args.workdir, f"moshed_{frame_count}_{window_count}.avi")
+    if not os.path.exists(input_file):
+        write_synthetic_avi(input_file, frame_count, gop=args.gop, i_size=args.i_size, p_size=args.p_size)
+    file_size = os.path.getsize(input_file)
+    results = {}
+
+    def parse():
+        extract_avi_data(input_file, use_sidecar=False).close()
+    results["extract_avi_data"] = measure(parse, args.repeat)
+
+    def load_sidecar():
+        extract_avi_data(input_file).close()
+    extract_avi_data(input_file).close()
+    results["extract_avi_data_sidecar"] = measure(load_sidecar, args.repeat)
+
+    with extract_avi_data(input_file, use_sidecar=False) as index:
+        # Decodes every idx1 entry, finding the idx1 header alone takes microseconds
+        results["collect_frame_flags"] = measure(lambda: collect_frame_flags(index), args.repeat)
+
+        start_at, end_at, transition_frames = mosh_windows(frame_count, window_count)
+        def mosh():
+            create_datamoshed_avi(index, input_file, output_file, start_at=start_at, end_at=end_at, duplicated_p_frames=1, transition_frames=transition_frames)
+        # Without the cached plan every run writes the whole output
+        results["create_datamoshed_avi"] = measure(mosh, args.repeat, setup=lambda: remove(plan_cache_path(input_file, output_file)))
+
+        # The same windows with 1..N duplicated P-frames, all written in one pass
+        variants = [{"output": f"{os.path.splitext(output_file)[0]}_v{k}.avi", "start_at": start_at, "end_at": end_at, "duplicated_p_frames": k, "transition_frames": transition_frames} for k in range(1, args.variants + 1)]
+        results["create_datamoshed_avis"] = measure(lambda: create_datamoshed_avis(index, variants), args.repeat)
+
+    for result in results.values():
+        result["mb_per_sec"] = file_size / result["best"] / 1e6 if result["best"] else None
+    if not args.keep:
+        for filename in [output_file, sidecar_path(input_file)] + plan_cache_files(input_file) + [variant["output"] for variant in variants]:
+            remove(filename)
+    return {"frames": frame_count, "gop": args.gop, "i_size": args.i_size, "p_size": args.p_size, "windows": window_count, "variants": args.variants, "file_size": file_size, "benchmarks": results, "max_rss": max_rss()}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--frames", type=int, nargs="+", default=[1000, 10000, 100000], help="frame counts to generate")
+    parser.add_argument("--gop", type=int, default=12, help="frames between I-frames")
+    parser.add_argument("--i-size", type=int, default=8000, help="mean I-frame size in bytes")
+    parser.add_argument("--p-size", type=int, default=800, help="mean P-frame size in bytes")
+    parser.add_argument("--windows", type=int, nargs="+", default=[4], help="mosh window counts")
+    parser.add_argument("--variants", type=int, default=3, help="outputs written by the single pass multi-variant benchmark")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per benchmark")
+    parser.add_argument("--workdir", default=DEFAULT_WORKDIR, help="where the synthetic files are generated and kept")
+    parser.add_argument("--output", help="write the JSON results here instead of stdout")
+    parser.add_argument("--keep", action="store_true", help="keep the moshed outputs and sidecar files")
+    args = parser.parse_args(argv)
+    os.makedirs(args.workdir, exist_ok=True)
+
+    cases = []
+    # Keep the addon's own output out of the JSON
+    with contextlib.redirect_stdout(sys.stderr):
+        for frame_count in args.frames:
+            for window_count in args.windows:
+                print(f"Benchmarking {frame_count} frames, {window_count} windows")
+                cases.append(run_case(args, frame_count, window_count))
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "max_rss": max_rss(),
+        "cases": cases,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+if __name__ == "__main__":
+    main()
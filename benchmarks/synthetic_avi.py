@@ -0,0 +1,86 @@
+#############################################################################
+# Datamosh addon for blender                                                #
+# Copyright (C) 2025 Dan Argust                                             #
+#                                                                           #
+#    This program is free software: you can redistribute it and/or modify   #
+#    it under the terms of the GNU General Public License as published by   #
+#    the Free Software Foundation, either version 3 of the License, or      #
+#    (at your option) any later version.                                    #
+#                                                                           #
+#    This program is distributed in the hope that it will be useful,        #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of         #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the          #
+#    GNU General Public License for more details.                           #
+#                                                                           #
+#    You should have received a copy of the GNU General Public License      #
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>. #
+#############################################################################
+
+import random
+import struct
+
+# Frame payloads start like ffmpeg's libxvid output: I-frames with the VOS
+# start code (0xb0) and a VOL ahead of their VOP, P-frames with just the VOP
+# start code (0xb6). The parser decodes the coding type from the first bits
+# of the VOP header, 0 for I and 1 for P here.
+I_FRAME_HEADER = b"\x00\x00\x01\xb0\x01\x00\x00\x01\xb5\x09\x00\x00\x01\x20\x08\x80\x40\x00\x00\x01\xb6\x10"
+P_FRAME_HEADER = b"\x00\x00\x01\xb6\x50"
+
+def _chunk_header(fourcc, size):
+    return fourcc + struct.pack("<I", size)
+
+def _chunk(fourcc, payload):
+    return _chunk_header(fourcc, len(payload)) + payload + b"\x00" * (len(payload) & 1)
+
+def _list(kind, payload):
+    return _chunk_header(b"LIST", len(payload) + 4) + kind + payload
+
+def frame_sizes(frame_count, gop=12, i_size=8000, p_size=800, jitter=0.5, seed=1):
+    """Payload size and keyframe flag of every frame, sizes varying by +-jitter."""
+    rnd = random.Random(seed)
+    frames = []
+    for i in range(frame_count):
+        key = i % gop == 0
+        mean = i_size if key else p_size
+        frames.append((max(int(mean * rnd.uniform(1 - jitter, 1 + jitter)), 16), key))
+    return frames
+
+def write_synthetic_avi(filename, frame_count, gop=12, i_size=8000, p_size=800, jitter=0.5, seed=1, width=1920, height=1080):
+    """Write an Xvid-style AVI 1.0 file of frame_count frames, returns its size.
+
+    Each frame is a VOP header the parser can classify followed by filler
+    without start codes, nothing past the header is ever decoded.
+    Everything is streamed, so 100k frame files are fine.
+    """
+    frames = frame_sizes(frame_count, gop, i_size, p_size, jitter, seed)
+    avih = struct.pack("<14I", 40000, 0, 0, 0x10, frame_count, 0, 1, 0, width, height, 0, 0, 0, 0)
+    strh = b"vids" + b"FMP4" + struct.pack("<IHHIIIIIIIIhhhh", 0, 0, 0, 0, 1, 25, 0, frame_count, 0, 0xffffffff, 0, 0, 0, width, height)
+    strf = struct.pack("<IiiHHIIiiII", 40, width, height, 1, 24, 0x44495658, width * height * 3, 0, 0, 0, 0)
+    # ffmpeg reserves room for an OpenDML super index in the strl
+    strl = _list(b"strl", _chunk(b"strh", strh) + _chunk(b"strf", strf) + _chunk(b"JUNK", bytes(4120)))
+    odml = _list(b"odml", _chunk(b"dmlh", struct.pack("<I", frame_count) + bytes(244)))
+    hdrl = _list(b"hdrl", _chunk(b"avih", avih) + strl + odml)
+    info = _list(b"INFO", _chunk(b"ISFT", b"Lavf58.76.100\x00"))
+    junk = _chunk(b"JUNK", bytes(1016))
+
+    movi_size = 4 + sum(8 + size + (size & 1) for size, key in frames)
+    idx1_size = 16 * frame_count
+    riff_size = 4 + len(hdrl) + len(info) + len(junk) + 8 + movi_size + 8 + idx1_size
+    filler = bytes((k * 7) & 0x7f | 0x80 for k in range(max(size for size, key in frames) + 1))
+
+    with open(filename, "wb") as f:
+        f.write(_chunk_header(b"RIFF", riff_size) + b"AVI " + hdrl + info + junk)
+        f.write(_chunk_header(b"LIST", movi_size) + b"movi")
+        for size, key in frames:
+            header = I_FRAME_HEADER if key else P_FRAME_HEADER
+            f.write(_chunk_header(b"00dc", size))
+            f.write(header[:size])
+            f.write(filler[:size - min(len(header), size) + (size & 1)])
+        f.write(_chunk_header(b"idx1", idx1_size))
+        offset = 4
+        entries = bytearray()
+        for size, key in frames:
+            entries += struct.pack("<4sIII", b"00dc", 0x10 if key else 0, offset, size)
+            offset += 8 + size + (size & 1)
+        f.write(entries)
+        return f.tell()
@@ -0,0 +1,61 @@
+#############################################################################
+# Datamosh addon for blender                                                #
+# Copyright (C) 2025 Dan Argust                                             #
+#                                                                           #
+#    This program is free software: you can redistribute it and/or modify   #
+#    it under the terms of the GNU General Public License as published by   #
+#    the Free Software Foundation, either version 3 of the License, or      #
+#    (at your option) any later version.                                    #
+#                                                                           #
+#    This program is distributed in the hope that it will be useful,        #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of         #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the          #
+#    GNU General Public License for more details.                           #
+#                                                                           #
+#    You should have received a copy of the GNU General Public License      #
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>. #
+#############################################################################
+
+from array import array
+from enum import IntEnum
+
+class VopType(IntEnum):
+    """Frame type codes stored in the frame table, matching MPEG-4 vop_coding_type"""
+    I = 0
+    P = 1
+    B = 2
+    S = 3
+    # Not coded (vop_coded 0), or an empty placeholder chunk: no picture of its own
+    N = 4
+    UNKNOWN = 255
+
+class FrameTable:
+    """Columnar frame data, one compact array per field instead of a dict per frame.
+
+    starts are absolute chunk header offsets, sizes are payload sizes, types
+    are VopType codes and flags are the matching idx1 flags.
+    """
+
+    def __init__(self):
+        self.starts = array("Q")
+        self.sizes = array("I")
+        self.types = bytearray()
+        self.flags = array("I")
+
+    def __len__(self):
+        return len(self.starts)
+
+    def positions(self, vop_type):
+        """Sorted indices of all frames of the given type."""
+        positions = []
+        find = self.types.find
+        i = find(vop_type)
+        while i != -1:
+            positions.append(i)
+            i = find(vop_type, i + 1)
+        return positions
+
+    def previous(self, vop_type, i):
+        """Index of the last frame of the given type before frame i, or None."""
+        j = self.types.rfind(vop_type, 0, i)
+        return None if j == -1 else j
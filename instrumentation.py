@@ -0,0 +1,135 @@
+#############################################################################
+# Datamosh addon for blender                                                #
+# Copyright (C) 2025 Dan Argust                                             #
+#                                                                           #
+#    This program is free software: you can redistribute it and/or modify   #
+#    it under the terms of the GNU General Public License as published by   #
+#    the Free Software Foundation, either version 3 of the License, or      #
+#    (at your option) any later version.                                    #
+#                                                                           #
+#    This program is distributed in the hope that it will be useful,        #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of         #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the          #
+#    GNU General Public License for more details.                           #
+#                                                                           #
+#    You should have received a copy of the GNU General Public License      #
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>. #
+#############################################################################
+
+
+import json
+import sys
+import time
+import tracemalloc
+try:
+    import resource
+except ImportError:
+    resource = None
+
+COUNTERS = ("bytes_read", "bytes_written", "frames", "swapped", "dropped")
+
+def format_bytes(count):
+    for unit in ("B", "KB", "MB", "GB"):
+        if count < 1000 or unit == "GB":
+            return f"{count:.0f} {unit}" if unit == "B" else f"{count:.1f} {unit}"
+        count /= 1000
+
+def max_rss():
+    """Peak resident set size of the process in bytes, None where unsupported."""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # KiB on Linux, bytes on macOS
+    return rss if sys.platform == "darwin" else rss * 1024
+
+class RunStats:
+    """Wall time, bytes read/written, frame counts and peak allocation per pipeline stage.
+
+    Stages are plain dicts so the panel can show them and save() can dump
+    them as they are. With trace_memory the peak allocation of each stage
+    comes from tracemalloc, which sees every thread, so anything Blender
+    allocates meanwhile is included. Tracing makes the run several times
+    slower, so it is off unless asked for. The peak RSS is only known for
+    the whole process since it started, Blender included, so it is taken
+    once when the run closes.
+    """
+
+    def __init__(self, trace_memory=False):
+        self.stages = []
+        self.trace_memory = trace_memory
+        self._started_tracing = False
+        self._stage_started = None
+        self.max_rss = None
+
+    @property
+    def current(self):
+        return self.stages[-1] if self.stages else None
+
+    def begin(self, name):
+        self.end()
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        # reset_peak needs Python 3.9, older Blenders get the peak since the run started
+        if tracemalloc.is_tracing() and hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+        stage = {"stage": name, "seconds": 0.0, "peak_alloc": None}
+        stage.update((counter, 0) for counter in COUNTERS)
+        self.stages.append(stage)
+        self._stage_started = time.perf_counter()
+
+    def add(self, **counters):
+        for counter, value in counters.items():
+            self.current[counter] += value
+
+    def end(self):
+        if self._stage_started is None:
+            return
+        self.current["seconds"] = time.perf_counter() - self._stage_started
+        if tracemalloc.is_tracing():
+            self.current["peak_alloc"] = tracemalloc.get_traced_memory()[1]
+        self._stage_started = None
+
+    def close(self):
+        self.end()
+        self.max_rss = max_rss()
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    def totals(self):
+        totals = {"seconds": sum(stage["seconds"] for stage in self.stages)}
+        for counter in ("bytes_read", "bytes_written"):
+            totals[counter] = sum(stage[counter] for stage in self.stages)
+        peaks = [stage["peak_alloc"] for stage in self.stages if stage["peak_alloc"] is not None]
+        totals["peak_alloc"] = max(peaks) if peaks else None
+        totals["max_rss"] = self.max_rss
+        return totals
+
+    def describe(self, stage):
+        """Two short lines summing up a stage, for the panel and the console."""
+        seconds = stage["seconds"]
+        moved = stage["bytes_read"] + stage["bytes_written"]
+        rate = f", {format_bytes(moved / seconds)}/s" if seconds and moved else ""
+        first = f"{stage['stage']}: {seconds:.2f}s, {format_bytes(stage['bytes_read'])} in, {format_bytes(stage['bytes_written'])} out{rate}"
+        second = f"{stage['frames']} frames"
+        if stage["swapped"] or stage["dropped"]:
+            second += f", {stage['swapped']} swapped, {stage['dropped']} dropped"
+        if stage["peak_alloc"] is not None:
+            second += f", peak {format_bytes(stage['peak_alloc'])}"
+        return [first, second]
+
+    def summary(self):
+        """One line for the whole run."""
+        totals = self.totals()
+        line = f"Last run: {totals['seconds']:.2f}s"
+        if totals["max_rss"] is not None:
+            line += f", process peak RSS {format_bytes(totals['max_rss'])}"
+        return line
+
+    def to_dict(self):
+        return {"stages": self.stages, "totals": self.totals()}
+
+    def save(self, filename):
+        with open(filename, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
@@ -0,0 +1,203 @@
+#############################################################################
+# Datamosh addon for blender                                                #
+# Copyright (C) 2025 Dan Argust                                             #
+#                                                                           #
+#    This program is free software: you can redistribute it and/or modify   #
+#    it under the terms of the GNU General Public License as published by   #
+#    the Free Software Foundation, either version 3 of the License, or      #
+#    (at your option) any later version.                                    #
+#                                                                           #
+#    This program is distributed in the hope that it will be useful,        #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of         #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the          #
+#    GNU General Public License for more details.                           #
+#                                                                           #
+#    You should have received a copy of the GNU General Public License      #
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>. #
+#############################################################################
+
+import glob
+import hashlib
+import json
+import os
+from bisect import bisect_left, bisect_right
+try:
+    from .frame_table import VopType
+except ImportError:
+    from frame_table import VopType
+
+PLAN_VERSION = 1
+
+def parse_frame_list(text):
+    """Parse a comma separated frame list such as the datamosh_* scene fields."""
+    return [int(x) for x in text.replace(" ", "").split(",") if x]
+
+def as_frame_list(frames):
+    """A single frame number or a list of them, as a list."""
+    return frames if isinstance(frames, (list, tuple)) else [frames]
+
+def merge_windows(start_at, end_at):
+    """Sort and merge the inclusive [start, end] mosh windows into disjoint intervals."""
+    merged = []
+    for start, end in sorted(zip(start_at, end_at)):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+def mosh_events(frames, start_at, end_at, transition_frames):
+    """Work out which frames get swapped and which get dropped.
+
+    Only the I-frame positions and the window/transition lists are visited,
+    so the cost is independent of the total number of frames. Returns
+    (swaps, drops) where swaps is a list of (frame, source P-frame) pairs and
+    drops is a sorted list of frames.
+    """
+    frame_count = len(frames)
+    drops = sorted(set(i for i in transition_frames if 0 <= i < frame_count))
+    dropped = set(drops)
+    i_frames = frames.positions(VopType.I)
+    swaps = []
+    for start, end in merge_windows(start_at, end_at):
+        for i in i_frames[bisect_left(i_frames, start):bisect_right(i_frames, end)]:
+            source = frames.previous(VopType.P, i)
+            # Nothing to swap in before the first P-frame
+            if i not in dropped and source is not None:
+                swaps.append((i, source))
+    return swaps, drops
+
+class MoshPlan:
+    """Run-length edit decision list describing a datamoshed file.
+
+    Each op refers to source frame numbers and is one of
+        ("copy", first, last)           copy frames first..last-1 unchanged
+        ("drop", first, last)           leave frames first..last-1 out
+        ("dup", frame, source, count)   replace frame with count copies of P-frame source
+        ("alias", frame, source, count) write P-frame source once in place of frame, indexed count times
+    """
+
+    def __init__(self, ops, params=None):
+        self.ops = ops
+        self.params = params or {}
+
+    def __eq__(self, other):
+        return isinstance(other, MoshPlan) and self.ops == other.ops
+
+    @property
+    def output_frame_count(self):
+        count = 0
+        for op in self.ops:
+            if op[0] == "copy":
+                count += op[2] - op[1]
+            elif op[0] in ("dup", "alias"):
+                count += op[3]
+        return count
+
+    @property
+    def swapped_count(self):
+        return sum(1 for op in self.ops if op[0] in ("dup", "alias"))
+
+    @property
+    def dropped_count(self):
+        return sum(op[2] - op[1] for op in self.ops if op[0] == "drop")
+
+    def common_prefix(self, other):
+        """Number of leading ops shared with another plan."""
+        count = 0
+        for a, b in zip(self.ops, other.ops):
+            if a != b:
+                break
+            count += 1
+        return count
+
+    def diff(self, other):
+        """Merged source frame ranges [first, last) whose treatment differs between the plans."""
+        changed = set(self.ops) ^ set(other.ops)
+        ranges = sorted((op[1], op[2]) if op[0] in ("copy", "drop") else (op[1], op[1] + 1) for op in changed)
+        merged = []
+        for first, last in ranges:
+            if merged and first <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], last)
+            else:
+                merged.append([first, last])
+        return [tuple(r) for r in merged]
+
+    def to_dict(self):
+        return {"version": PLAN_VERSION, "params": self.params, "ops": [list(op) for op in self.ops]}
+
+    @classmethod
+    def from_dict(cls, data):
+        if data.get("version") != PLAN_VERSION:
+            raise ValueError(f"Unsupported mosh plan version: {data.get('version')}")
+        return cls([tuple(op) for op in data["ops"]], data.get("params"))
+
+def compile_mosh_plan(frames, start_at, end_at, transition_frames, duplicated_p_frames=0, alias_duplicates=False):
+    """Turn the datamosh parameters into a MoshPlan for the given frame table.
+
+    With alias_duplicates the duplicated P-frames are index entries pointing
+    at a single stored copy rather than copies of their own.
+    """
+    params = {"start_at": list(start_at), "end_at": list(end_at), "transition_frames": list(transition_frames), "duplicated_p_frames": duplicated_p_frames}
+    if alias_duplicates:
+        params["alias_duplicates"] = True
+    dup = "alias" if alias_duplicates and duplicated_p_frames else "dup"
+    swaps, drops = mosh_events(frames, start_at, end_at, transition_frames)
+    events = sorted([(i, source) for i, source in swaps] + [(i, None) for i in drops])
+    ops = []
+    copy_from = 0
+    for i, source in events:
+        if copy_from < i:
+            ops.append(("copy", copy_from, i))
+        if source is None:
+            if ops and ops[-1][0] == "drop" and ops[-1][2] == i:
+                ops[-1] = ("drop", ops[-1][1], i + 1)
+            else:
+                ops.append(("drop", i, i + 1))
+        else:
+            ops.append((dup, i, source, duplicated_p_frames + 1))
+        copy_from = i + 1
+    if copy_from < len(frames):
+        ops.append(("copy", copy_from, len(frames)))
+    return MoshPlan(ops, params)
+
+def plan_cache_path(input_filename, output_filename):
+    """One file per output, so outputs sharing an input keep their own plans."""
+    output_hash = hashlib.sha1(os.path.abspath(output_filename).encode()).hexdigest()[:12]
+    return f"{input_filename}.{output_hash}.moshplan.json"
+
+def plan_cache_files(input_filename):
+    """The cached plans of every output made from input_filename."""
+    return glob.glob(glob.escape(input_filename) + ".*.moshplan.json")
+
+def file_identity(filename):
+    stat = os.stat(filename)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def save_cached_plan(input_filename, output_filename, plan):
+    """Remember the plan that produced output_filename from input_filename."""
+    data = {
+        "input": file_identity(input_filename),
+        "output": os.path.abspath(output_filename),
+        "output_identity": file_identity(output_filename),
+        "plan": plan.to_dict(),
+    }
+    # Written aside and renamed so concurrent jobs never read a partial file
+    path = plan_cache_path(input_filename, output_filename)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(temp_path, path)
+
+def load_cached_plan(input_filename, output_filename):
+    """The cached plan for this input/output pair, or None if either file changed since."""
+    try:
+        with open(plan_cache_path(input_filename, output_filename)) as f:
+            data = json.load(f)
+        if data["input"] != file_identity(input_filename) or data["output"] != os.path.abspath(output_filename):
+            return None
+        if data["output_identity"] != file_identity(output_filename):
+            return None
+        return MoshPlan.from_dict(data["plan"])
+    except (OSError, ValueError, KeyError):
+        return None
@@ -19,56 +19,112 @@
 import bpy # type: ignore
 import os
 import subprocess
-from bpy.props import StringProperty, BoolProperty # type: ignore
+from bpy.props import StringProperty, BoolProperty, EnumProperty, IntProperty # type: ignore
 from bpy.types import Operator, Panel # type: ignore
-from .parse_raw_avi import convert_to_avi, extract_avi_data, create_datamoshed_avi
+from . import parse_raw_avi
+from .mosh_plan import parse_frame_list
+from .pipeline import DatamoshJob, CutDetectionJob
+from .avi_cache import ConversionCache
+from .scene_cuts import propose_mosh_points
+
+def conversion_cache(scene):
+    if not scene.datamosh_use_cache:
+        return None
+    directory = bpy.path.abspath(scene.datamosh_cache_dir) if scene.datamosh_cache_dir else None
+    return ConversionCache(directory, budget=int(scene.datamosh_cache_budget * (1 << 30)))
+
+def redraw_panels(context):
+    for area in context.screen.areas if context.screen else []:
+        if area.type == 'SEQUENCE_EDITOR':
+            area.tag_redraw()
+
+def variant_jobs(scene, base, suffix):
+    """Parameter sets of the scene's variants for DatamoshJob, each with its own output file."""
+    variants = []
+    for k, variant in enumerate(scene.datamosh_variants):
+        name = bpy.path.clean_name(variant.name) if variant.name else str(k + 1)
+        variants.append({
+            "output_file": f"{base}{suffix}_{name}.avi",
+            "start_points": parse_frame_list(variant.start_points),
+            "end_points": parse_frame_list(variant.end_points),
+            "transition_frames": parse_frame_list(variant.start_frames),
+            "duplicated_p_frames": variant.duplicated_p_frames,
+        })
+    return variants
 
 class DATAMOSH_OT_run_datamosh(bpy.types.Operator):
     bl_idname = "datamosh.run_datamosh"
     bl_label = "Run Datamosh"
-    bl_description = "Run the datamoshing script on the rendered video"
+    bl_description = "Run the datamoshing script on the rendered video (ESC to cancel)"
+
+    preview: BoolProperty(
+        name="Preview",
+        description="Mosh a downscaled, low quality proxy of the render for a quick look",
+        default=False,
+        options={'SKIP_SAVE'}
+    )
+    input_file: StringProperty(
+        name="Input File",
+        description="Video to mosh instead of the scene's render output",
+        default="",
+        options={'SKIP_SAVE', 'HIDDEN'}
+    )
+
+    # The job currently running and the stats of the last one, shown by the panel
+    active_job = None
+    last_stats = None
 
     _timer = None
-    _progress = 0.0
 
     def execute(self, context):
         print(f"Running datamosh script by Dan Argust")
         scene = context.scene
 
-        self.rendered_video = scene.render.frame_path()
+        if DATAMOSH_OT_run_datamosh.active_job is not None:
+            self.report({'ERROR'}, "A datamosh is already running.")
+            return {'CANCELLED'}
+
+        self.rendered_video = self.input_file or scene.render.frame_path()
         print(f"frame path: {self.rendered_video}")
 
         if not os.path.exists(self.rendered_video):
             self.report({'ERROR'}, "Rendered video file does not exist.")
             return {'CANCELLED'}
-        
-        self.input_file = self.rendered_video
-        self.temp_file = os.path.splitext(self.input_file)[0] + "_temp.avi"
-        self.output_file = os.path.splitext(self.input_file)[0] + "_glitched.avi"
 
-        if self.input_file[:-4] == ".avi":
-            self.temp_file = self.input_file
+        self.input_file = self.rendered_video
+        base = os.path.splitext(self.input_file)[0]
+        suffix = "_glitched_preview" if self.preview else "_glitched"
+        self.output_file = base + suffix + ".avi"
+        variants = variant_jobs(scene, base, suffix) if scene.datamosh_use_variants else None
 
         self.sequence_editor = scene.sequence_editor
         if not self.sequence_editor:
             self.report({'ERROR'}, "No sequence editor found in the current scene.")
             return {'CANCELLED'}
 
-        self.start_frames = [int(x) for x in scene.datamosh_start_frames.split(',')]
-        self.start_points = [int(x) for x in scene.datamosh_start_points.split(',')]
-        self.end_points = [int(x) for x in scene.datamosh_end_points.split(',')]
-
-        self.steps = [
-            self.convert_to_avi_step,
-            self.extract_avi_data_step,
-            self.create_datamoshed_avi_step,
-            self.add_movie_strip_step,
-            self.cleanup_temp_files
-        ]
-        if self.input_file == self.temp_file:
-            self.steps = self.steps[1:]
-
-        self.current_step = 0
+        parse_raw_avi.debug_global = scene.datamosh_log_level
+        self.job = DatamoshJob(
+            self.input_file,
+            self.output_file,
+            start_points=parse_frame_list(scene.datamosh_start_points),
+            end_points=parse_frame_list(scene.datamosh_end_points),
+            transition_frames=parse_frame_list(scene.datamosh_start_frames),
+            duplicated_p_frames=scene.datamosh_duplicated_p_frames,
+            compression=scene.datamosh_preview_quantizer if self.preview else 3,
+            scale=scene.datamosh_preview_scale if self.preview else None,
+            total_frames=scene.frame_end - scene.frame_start + 1,
+            workers=scene.datamosh_convert_workers,
+            windows_only=scene.datamosh_windows_only,
+            fps=scene.render.fps / scene.render.fps_base,
+            cache=conversion_cache(scene),
+            trace_memory=scene.datamosh_trace_memory,
+            report_file=os.path.splitext(self.output_file)[0] + "_report.json" if scene.datamosh_save_report else None,
+            variants=variants,
+            alias_duplicates=scene.datamosh_alias_duplicates,
+            checkpoint_interval=scene.datamosh_checkpoint_interval if scene.datamosh_show_progress else None,
+        )
+        self.job.start()
+        DATAMOSH_OT_run_datamosh.active_job = self.job
 
         wm = context.window_manager
         self._timer = wm.event_timer_add(0.1, window=context.window)
@@ -76,35 +132,107 @@ class DATAMOSH_OT_run_datamosh(bpy.types.Operator):
         return {'RUNNING_MODAL'}
 
     def modal(self, context, event):
-        if event.type == 'TIMER':
-            if self.current_step < len(self.steps):
-                self.steps[self.current_step]()
-                self.current_step += 1
-                self._progress = self.current_step / len(self.steps)
-                context.area.tag_redraw()
-            else:
-                self.report({'INFO'}, "Datamoshing complete")
-                wm = context.window_manager
-                wm.event_timer_remove(self._timer)
-                return {'FINISHED'}
-        return {'RUNNING_MODAL'}
+        if event.type == 'ESC' and event.value == 'PRESS' and self.job.running:
+            print("Cancelling datamosh...")
+            self.job.cancel()
+            return {'RUNNING_MODAL'}
+        if event.type != 'TIMER':
+            # Leave the rest of the UI usable while the worker runs
+            return {'PASS_THROUGH'}
+        for message, *args in self.job.poll():
+            if message == "progress":
+                redraw_panels(context)
+            elif message == "checkpoint":
+                # The first part of the output is playable, show it while the rest is written
+                print(f"Checkpoint: {args[1]} frames written")
+                try:
+                    self.show_movie_strip(args[0], context.scene.frame_start)
+                finally:
+                    # Blender has read the interim index, the worker can write over it
+                    args[2].set()
+            elif message == "done":
+                self.add_movie_strips(context, args[0])
+                self.report({'INFO'}, "Datamosh preview ready" if self.preview else "Datamoshing complete")
+                return self.finish(context, {'FINISHED'})
+            elif message == "cancelled":
+                self.report({'WARNING'}, "Datamoshing cancelled")
+                return self.finish(context, {'CANCELLED'})
+            elif message == "error":
+                self.report({'ERROR'}, f"Datamoshing failed: {args[0]}")
+                return self.finish(context, {'CANCELLED'})
+        return {'PASS_THROUGH'}
+
+    def finish(self, context, result):
+        context.window_manager.event_timer_remove(self._timer)
+        # A cancelled or failed run deletes the output a checkpoint may have shown
+        sequence = self.find_movie_strip(self.output_file)
+        if sequence is not None and not os.path.exists(self.output_file):
+            self.sequence_editor.sequences.remove(sequence)
+        DATAMOSH_OT_run_datamosh.active_job = None
+        DATAMOSH_OT_run_datamosh.last_stats = self.job.stats
+        redraw_panels(context)
+        return result
 
-    def convert_to_avi_step(self):
-        print(f"Converting to AVI: {self.input_file}")
-        convert_to_avi(self.input_file, self.temp_file)
+    def remove_movie_strips(self, prefix, keep=()):
+        """Remove strips of earlier results, all whose files start with prefix except those in keep."""
+        prefix = os.path.normpath(prefix)
+        for sequence in list(self.sequence_editor.sequences):
+            if sequence.type != 'MOVIE':
+                continue
+            filepath = os.path.normpath(bpy.path.abspath(sequence.filepath))
+            if filepath.startswith(prefix) and filepath.lower().endswith(".avi") and filepath not in keep:
+                print(f"Removing movie strip: {sequence.filepath}")
+                self.sequence_editor.sequences.remove(sequence)
 
-    def extract_avi_data_step(self):
-        print(f"Extracting AVI data: {self.temp_file}")
-        self.avi_data = extract_avi_data(self.temp_file)
+    def find_movie_strip(self, filepath):
+        filepath = os.path.normpath(filepath)
+        for sequence in self.sequence_editor.sequences_all:
+            if sequence.type == 'MOVIE' and os.path.normpath(bpy.path.abspath(sequence.filepath)) == filepath:
+                return sequence
+        return None
 
-    def create_datamoshed_avi_step(self):
-        print(f"Creating datamoshed AVI: {self.output_file}")
-        create_datamoshed_avi(self.avi_data, self.temp_file, self.output_file, start_at=self.start_points, end_at=self.end_points, duplicated_p_frames=0, transition_frames=self.start_frames)
+    def show_movie_strip(self, filepath, frame_start, channel=None):
+        """Reload the strip already showing filepath in place, or add one."""
+        sequence = self.find_movie_strip(filepath)
+        if sequence is None:
+            self.add_movie_strip_step(filepath, frame_start, channel)
+            return
+        print(f"Reloading movie strip: {filepath}")
+        # Assigning the path reopens the file, reload picks up its new length
+        sequence.filepath = sequence.filepath
+        selected = [s for s in self.sequence_editor.sequences_all if s.select]
+        for s in selected:
+            s.select = False
+        sequence.select = True
+        bpy.ops.sequencer.reload(adjust_length=True)
+        sequence.select = False
+        for s in selected:
+            s.select = True
+
+    def add_movie_strips(self, context, outputs):
+        # A preview replaces the last preview, a final result replaces both;
+        # strips already showing one of the outputs are reloaded in place
+        keep = {os.path.normpath(filepath) for filepath, first_frame in outputs}
+        self.remove_movie_strips(os.path.splitext(self.output_file)[0], keep)
+        # Window clips go on a channel above everything so they overlay the edit,
+        # variants each get a channel of their own
+        channel = max([sequence.channel for sequence in self.sequence_editor.sequences_all], default=0) + 1
+        for k, (filepath, first_frame) in enumerate(outputs):
+            frame_start = context.scene.frame_start + first_frame
+            if len(outputs) == 1 and first_frame == 0:
+                self.show_movie_strip(filepath, frame_start)
+            elif self.job.variants:
+                self.show_movie_strip(filepath, frame_start, channel + k)
+            else:
+                self.show_movie_strip(filepath, frame_start, channel)
 
-    def add_movie_strip_step(self):
-        print(f"Adding movie strip: {self.output_file}")
+    def add_movie_strip_step(self, filepath, frame_start, channel=None):
+        print(f"Adding movie strip: {filepath}")
         sequences_before = set(self.sequence_editor.sequences_all)
-        bpy.ops.sequencer.movie_strip_add(filepath=self.output_file, frame_start=1)
+        if channel is None:
+            bpy.ops.sequencer.movie_strip_add(filepath=filepath, frame_start=frame_start)
+        else:
+            bpy.ops.sequencer.movie_strip_add(filepath=filepath, frame_start=frame_start, channel=channel)
         sequences_after = set(self.sequence_editor.sequences_all)
         new_sequence = (sequences_after - sequences_before).pop()
         if new_sequence.type == 'MOVIE':
@@ -114,54 +242,220 @@ class DATAMOSH_OT_run_datamosh(bpy.types.Operator):
             new_sequence.proxy.build_75 = False
             new_sequence.proxy.build_100 = False
             new_sequence.proxy.quality = 50
-    
-    def cleanup_temp_files(self):
-        print(f"Cleaning up temp files: {self.temp_file}")
-        if os.path.exists(self.temp_file):
-            os.remove(self.temp_file)
-        else:
-            print("Temp file not found")
-
-    def draw(self, context):
-        layout = self.layout
-        layout.label(text="Datamoshing in progress...")
-        layout.prop(self, "_progress", text="Progress")
 
 class DATAMOSH_OT_get_start_frames(bpy.types.Operator):
     bl_idname = "datamosh.get_start_frames"
     bl_label = "Get Start Frames"
-    bl_description = "Get the start frames of all movie sequences in the sequencer"
+    bl_description = "Get the start frames of all movie sequences in the sequencer, or detect the cuts in the rendered video"
+
+    source: EnumProperty(
+        name="Source",
+        items=[
+            ('STRIPS', "Strip Starts", "Start frames of the movie strips in the sequencer"),
+            ('CONTENT', "Scene Cuts", "Cuts detected in the rendered video, including ones inside a strip"),
+        ],
+        default='STRIPS'
+    )
+
+    _timer = None
 
     def execute(self, context):
         scene = context.scene
         sequence_editor = scene.sequence_editor
 
+        if self.source == 'CONTENT':
+            return self.start_cut_detection(context)
+
         if not sequence_editor:
             self.report({'ERROR'}, "No sequence editor found in the current scene.")
             return {'CANCELLED'}
 
-        start_frames = []
+        transitions = []
         for sequence in sequence_editor.sequences_all:
             if sequence.type == 'MOVIE':
-                frame = int(sequence.frame_final_start) - 1
-                if frame > 11:
-                    start_frames.append(frame)
+                transitions.append(int(sequence.frame_final_start) - 1)
+        self.set_mosh_points(scene, transitions)
+        return {'FINISHED'}
 
+    def set_mosh_points(self, scene, transitions):
+        start_frames, start_points, end_points = propose_mosh_points(sorted(transitions))
         scene.datamosh_start_frames = ','.join(map(str, start_frames))
-        scene.datamosh_start_points = ','.join(map(str, [frame - 10 for frame in start_frames]))
-        scene.datamosh_end_points = ','.join(map(str, [frame + 60 for frame in start_frames]))
+        scene.datamosh_start_points = ','.join(map(str, start_points))
+        scene.datamosh_end_points = ','.join(map(str, end_points))
         self.report({'INFO'}, f"Start frames: {start_frames}")
         self.report({'INFO'}, f"Start points: {scene.datamosh_start_points}")
         self.report({'INFO'}, f"End points: {scene.datamosh_end_points}")
+
+    def start_cut_detection(self, context):
+        """Detect the scene cuts of the rendered video on a worker, the conversion can take minutes."""
+        scene = context.scene
+        if DATAMOSH_OT_run_datamosh.active_job is not None:
+            self.report({'ERROR'}, "A datamosh is already running.")
+            return {'CANCELLED'}
+        rendered_video = scene.render.frame_path()
+        if not os.path.exists(rendered_video):
+            self.report({'ERROR'}, "Rendered video file does not exist.")
+            return {'CANCELLED'}
+        # Converted the same way as Run Datamosh, so a cached conversion serves both
+        self.job = CutDetectionJob(
+            rendered_video,
+            total_frames=scene.frame_end - scene.frame_start + 1,
+            workers=scene.datamosh_convert_workers,
+            cache=conversion_cache(scene),
+        )
+        self.job.start()
+        # Shown by the panel and keeps Run Datamosh off the same temp file meanwhile
+        DATAMOSH_OT_run_datamosh.active_job = self.job
+
+        wm = context.window_manager
+        self._timer = wm.event_timer_add(0.1, window=context.window)
+        wm.modal_handler_add(self)
+        return {'RUNNING_MODAL'}
+
+    def modal(self, context, event):
+        if event.type == 'ESC' and event.value == 'PRESS' and self.job.running:
+            print("Cancelling cut detection...")
+            self.job.cancel()
+            return {'RUNNING_MODAL'}
+        if event.type != 'TIMER':
+            return {'PASS_THROUGH'}
+        for message, *args in self.job.poll():
+            if message == "progress":
+                redraw_panels(context)
+            elif message == "done":
+                self.set_mosh_points(context.scene, args[0])
+                return self.finish(context, {'FINISHED'})
+            elif message == "cancelled":
+                self.report({'WARNING'}, "Cut detection cancelled")
+                return self.finish(context, {'CANCELLED'})
+            elif message == "error":
+                self.report({'ERROR'}, f"Cut detection failed: {args[0]}")
+                return self.finish(context, {'CANCELLED'})
+        return {'PASS_THROUGH'}
+
+    def finish(self, context, result):
+        context.window_manager.event_timer_remove(self._timer)
+        DATAMOSH_OT_run_datamosh.active_job = None
+        redraw_panels(context)
+        return result
+
+# Render settings of the native render and what they are set to; the
+# bitrate and GOP size come from the scene's datamosh properties
+NATIVE_RENDER_SETTINGS = (
+    ("image_settings", "file_format", "FFMPEG"),
+    ("ffmpeg", "format", "AVI"),
+    # ffmpeg's mpeg4 encoder writes the same MPEG-4 Part 2 stream as Xvid
+    ("ffmpeg", "codec", "MPEG4"),
+    ("ffmpeg", "use_max_b_frames", True),
+    ("ffmpeg", "max_b_frames", 0),
+    ("ffmpeg", "constant_rate_factor", "NONE"),
+    ("ffmpeg", "audio_codec", "NONE"),
+    ("ffmpeg", "video_bitrate", None),
+    ("ffmpeg", "maxrate", None),
+    ("ffmpeg", "gopsize", None),
+)
+
+def run_in_window(operator):
+    """Call operator with a window in the context, handlers and timers run without one."""
+    window = bpy.context.window_manager.windows[0]
+    if hasattr(bpy.context, "temp_override"):
+        with bpy.context.temp_override(window=window, screen=window.screen):
+            operator()
+    else:
+        operator({"window": window, "screen": window.screen})
+
+class DATAMOSH_OT_render_native(bpy.types.Operator):
+    bl_idname = "datamosh.render_native"
+    bl_label = "Render and Mosh"
+    bl_description = "Render the animation straight to an MPEG-4 AVI and datamosh it as soon as the render ends, without converting an MP4"
+
+    # Render settings to put back, None while no native render is running
+    saved_settings = None
+
+    def execute(self, context):
+        scene = context.scene
+        if DATAMOSH_OT_render_native.saved_settings is not None or DATAMOSH_OT_run_datamosh.active_job is not None:
+            self.report({'ERROR'}, "A datamosh is already running.")
+            return {'CANCELLED'}
+        if not scene.sequence_editor:
+            self.report({'ERROR'}, "No sequence editor found in the current scene.")
+            return {'CANCELLED'}
+
+        values = {"video_bitrate": scene.datamosh_native_bitrate, "maxrate": scene.datamosh_native_bitrate, "gopsize": scene.datamosh_native_gop}
+        saved = []
+        for group, attribute, value in NATIVE_RENDER_SETTINGS:
+            settings = getattr(scene.render, group)
+            saved.append((settings, attribute, getattr(settings, attribute)))
+            setattr(settings, attribute, values[attribute] if value is None else value)
+        DATAMOSH_OT_render_native.saved_settings = saved
+        bpy.app.handlers.render_complete.append(render_native_complete)
+        bpy.app.handlers.render_cancel.append(render_native_cancel)
+        print(f"Rendering to {scene.render.frame_path()}")
+        bpy.ops.render.render('INVOKE_DEFAULT', animation=True)
+        return {'FINISHED'}
+
+def end_native_render():
+    for settings, attribute, value in DATAMOSH_OT_render_native.saved_settings or []:
+        setattr(settings, attribute, value)
+    DATAMOSH_OT_render_native.saved_settings = None
+    for handlers, handler in ((bpy.app.handlers.render_complete, render_native_complete), (bpy.app.handlers.render_cancel, render_native_cancel)):
+        if handler in handlers:
+            handlers.remove(handler)
+
+def render_native_complete(scene, *args):
+    # frame_path() has to be read before the settings are restored
+    rendered_video = scene.render.frame_path()
+    end_native_render()
+    print(f"Render complete, datamoshing {rendered_video}")
+    def start():
+        run_in_window(lambda *override: bpy.ops.datamosh.run_datamosh(*override, input_file=rendered_video))
+    # Operators can't be started from inside the render handler
+    bpy.app.timers.register(start, first_interval=0.1)
+
+def render_native_cancel(scene, *args):
+    print("Render cancelled")
+    end_native_render()
+
+class DATAMOSH_OT_add_variant(bpy.types.Operator):
+    bl_idname = "datamosh.add_variant"
+    bl_label = "Add Variant"
+    bl_description = "Add a variant with the current frames and settings, all variants are moshed in one pass"
+
+    def execute(self, context):
+        scene = context.scene
+        variant = scene.datamosh_variants.add()
+        variant.name = f"v{len(scene.datamosh_variants)}"
+        variant.start_frames = scene.datamosh_start_frames
+        variant.start_points = scene.datamosh_start_points
+        variant.end_points = scene.datamosh_end_points
+        variant.duplicated_p_frames = scene.datamosh_duplicated_p_frames
+        return {'FINISHED'}
+
+class DATAMOSH_OT_remove_variant(bpy.types.Operator):
+    bl_idname = "datamosh.remove_variant"
+    bl_label = "Remove Variant"
+    bl_description = "Remove this variant"
+
+    index: IntProperty(options={'SKIP_SAVE'})
+
+    def execute(self, context):
+        context.scene.datamosh_variants.remove(self.index)
         return {'FINISHED'}
 
 def register():
     bpy.utils.register_class(DATAMOSH_OT_run_datamosh)
     bpy.utils.register_class(DATAMOSH_OT_get_start_frames)
+    bpy.utils.register_class(DATAMOSH_OT_render_native)
+    bpy.utils.register_class(DATAMOSH_OT_add_variant)
+    bpy.utils.register_class(DATAMOSH_OT_remove_variant)
 
 def unregister():
     bpy.utils.unregister_class(DATAMOSH_OT_run_datamosh)
     bpy.utils.unregister_class(DATAMOSH_OT_get_start_frames)
+    bpy.utils.unregister_class(DATAMOSH_OT_render_native)
+    end_native_render()
+    bpy.utils.unregister_class(DATAMOSH_OT_add_variant)
+    bpy.utils.unregister_class(DATAMOSH_OT_remove_variant)
 
 if __name__ == "__main__":
     register()
@@ -17,7 +17,15 @@
 #############################################################################
 
 import bpy
-from bpy.props import StringProperty
+from bpy.props import StringProperty, IntProperty, BoolProperty, FloatProperty, CollectionProperty
+from .operator import DATAMOSH_OT_run_datamosh
+
+class DatamoshVariant(bpy.types.PropertyGroup):
+    name: StringProperty(name="Name", description="Added to the name of this variant's output", default="")
+    start_frames: StringProperty(name="Transition Frames", default="")
+    start_points: StringProperty(name="Start Frames", default="")
+    end_points: StringProperty(name="End Frames", default="")
+    duplicated_p_frames: IntProperty(name="Duplicated P-Frames", default=0, min=0)
 
 class DATAMOSH_PT_panel(bpy.types.Panel):
     bl_label = "Datamosh"
@@ -33,17 +41,69 @@ class DATAMOSH_PT_panel(bpy.types.Panel):
 
         has_sequences = sequence_editor and len(sequence_editor.sequences_all) > 0
         has_valid_inputs = bool(scene.datamosh_start_frames.strip()) and bool(scene.datamosh_start_points.strip()) and bool(scene.datamosh_end_points.strip())
+        if scene.datamosh_use_variants:
+            has_valid_inputs = len(scene.datamosh_variants) > 0
+
+        job = DATAMOSH_OT_run_datamosh.active_job
+        if job is not None:
+            layout.label(text=f"{job.title} ({job.stage}): {job.progress:.0%}")
+            if job.eta is not None:
+                layout.label(text=f"About {int(job.eta) // 60}:{int(job.eta) % 60:02d} left in this step")
+            layout.label(text="Press ESC to cancel")
+        elif (has_sequences and has_valid_inputs):
+            row = layout.row()
+            row.operator("datamosh.run_datamosh", text="Preview").preview = True
+            row.operator("datamosh.run_datamosh", text="Render Final")
+            layout.operator("datamosh.render_native")
 
-        if (has_sequences and has_valid_inputs):
-            layout.operator("datamosh.run_datamosh", text="Run Datamosh")
+        stats = DATAMOSH_OT_run_datamosh.last_stats
+        if job is None and stats is not None and stats.stages:
+            box = layout.box()
+            box.label(text=stats.summary())
+            for stage in stats.stages:
+                for line in stats.describe(stage):
+                    box.label(text=line)
 
-        layout.operator("datamosh.get_start_frames", text="Get Start Frames")
+        row = layout.row()
+        row.operator("datamosh.get_start_frames", text="Get Start Frames").source = 'STRIPS'
+        row.operator("datamosh.get_start_frames", text="Detect Cuts").source = 'CONTENT'
 
         layout.prop(scene, "datamosh_start_frames")
         layout.prop(scene, "datamosh_start_points")
         layout.prop(scene, "datamosh_end_points")
+        layout.prop(scene, "datamosh_duplicated_p_frames")
+        layout.prop(scene, "datamosh_alias_duplicates")
+        layout.prop(scene, "datamosh_use_variants")
+        if scene.datamosh_use_variants:
+            for k, variant in enumerate(scene.datamosh_variants):
+                box = layout.box()
+                row = box.row()
+                row.prop(variant, "name")
+                row.operator("datamosh.remove_variant", text="", icon='X').index = k
+                box.prop(variant, "start_frames")
+                box.prop(variant, "start_points")
+                box.prop(variant, "end_points")
+                box.prop(variant, "duplicated_p_frames")
+            layout.operator("datamosh.add_variant")
+        layout.prop(scene, "datamosh_native_bitrate")
+        layout.prop(scene, "datamosh_native_gop")
+        layout.prop(scene, "datamosh_convert_workers")
+        layout.prop(scene, "datamosh_windows_only")
+        layout.prop(scene, "datamosh_preview_scale")
+        layout.prop(scene, "datamosh_preview_quantizer")
+        layout.prop(scene, "datamosh_use_cache")
+        if scene.datamosh_use_cache:
+            layout.prop(scene, "datamosh_cache_dir")
+            layout.prop(scene, "datamosh_cache_budget")
+        layout.prop(scene, "datamosh_show_progress")
+        if scene.datamosh_show_progress:
+            layout.prop(scene, "datamosh_checkpoint_interval")
+        layout.prop(scene, "datamosh_log_level")
+        layout.prop(scene, "datamosh_trace_memory")
+        layout.prop(scene, "datamosh_save_report")
 
 def register():
+    bpy.utils.register_class(DatamoshVariant)
     bpy.utils.register_class(DATAMOSH_PT_panel)
     bpy.types.Scene.datamosh_start_frames = StringProperty(
         name="Transition Frames",
@@ -60,12 +120,131 @@ def register():
         description="End points for datamoshing",
         default=""
     )
+    bpy.types.Scene.datamosh_duplicated_p_frames = IntProperty(
+        name="Duplicated P-Frames",
+        description="Extra copies of the P-frame written in place of each removed I-frame",
+        default=0,
+        min=0
+    )
+    bpy.types.Scene.datamosh_alias_duplicates = BoolProperty(
+        name="Index Duplicates Only",
+        description="Store each duplicated P-frame once and repeat its index entry, so long blooms cost almost no disk space. Players that ignore the AVI index show the frame only once",
+        default=False
+    )
+    bpy.types.Scene.datamosh_variants = CollectionProperty(type=DatamoshVariant)
+    bpy.types.Scene.datamosh_use_variants = BoolProperty(
+        name="Variants",
+        description="Mosh each variant below into its own file in a single pass over the render, instead of the frames above",
+        default=False
+    )
+    bpy.types.Scene.datamosh_windows_only = BoolProperty(
+        name="Transitions Only",
+        description="Convert and mosh only the frames between each start and end point, adding them as overlay strips instead of a full-length file",
+        default=False
+    )
+    bpy.types.Scene.datamosh_preview_scale = FloatProperty(
+        name="Preview Scale",
+        description="Size of the preview proxy relative to the render",
+        default=0.25,
+        min=0.05,
+        max=1.0,
+        subtype='FACTOR'
+    )
+    bpy.types.Scene.datamosh_preview_quantizer = IntProperty(
+        name="Preview Quantizer",
+        description="Xvid quantizer of the preview proxy, higher is smaller and faster to write",
+        default=12,
+        min=1,
+        max=31
+    )
+    bpy.types.Scene.datamosh_use_cache = BoolProperty(
+        name="Cache Conversions",
+        description="Keep converted AVIs so re-moshing an unchanged render skips the ffmpeg conversion",
+        default=True
+    )
+    bpy.types.Scene.datamosh_cache_dir = StringProperty(
+        name="Cache Directory",
+        description="Where converted AVIs are kept, empty uses the system temp directory",
+        default="",
+        subtype='DIR_PATH'
+    )
+    bpy.types.Scene.datamosh_cache_budget = FloatProperty(
+        name="Cache Size (GB)",
+        description="Least recently used conversions are removed once the cache grows beyond this",
+        default=20.0,
+        min=0.0
+    )
+    bpy.types.Scene.datamosh_native_bitrate = IntProperty(
+        name="Render Bitrate (kb/s)",
+        description="Bitrate of the MPEG-4 AVI written by Render and Mosh",
+        default=20000,
+        min=100
+    )
+    bpy.types.Scene.datamosh_native_gop = IntProperty(
+        name="Render Keyframe Interval",
+        description="Most frames between I-frames in the AVI written by Render and Mosh",
+        default=250,
+        min=1
+    )
+    bpy.types.Scene.datamosh_convert_workers = IntProperty(
+        name="Conversion Workers",
+        description="Number of ffmpeg processes used to convert the render to Xvid, 0 uses one per CPU",
+        default=0,
+        min=0
+    )
+    bpy.types.Scene.datamosh_show_progress = BoolProperty(
+        name="Show While Writing",
+        description="Make the glitched AVI playable at regular intervals while it is written and reload its strip each time, so the first transitions can be judged before the rest is done",
+        default=True
+    )
+    bpy.types.Scene.datamosh_checkpoint_interval = FloatProperty(
+        name="Refresh Interval (s)",
+        description="Seconds between refreshes of the glitched strip while the AVI is written",
+        default=5.0,
+        min=0.5
+    )
+    bpy.types.Scene.datamosh_log_level = IntProperty(
+        name="Log Level",
+        description="0 prints a summary per step to the console, 1 also prints a line per swapped or skipped frame",
+        default=0,
+        min=0,
+        max=1
+    )
+    bpy.types.Scene.datamosh_trace_memory = BoolProperty(
+        name="Measure Memory",
+        description="Track the peak memory allocated in each step with tracemalloc, which makes the run several times slower",
+        default=False
+    )
+    bpy.types.Scene.datamosh_save_report = BoolProperty(
+        name="Save Report",
+        description="Write the timings and counts of each run as JSON next to the glitched AVI",
+        default=False
+    )
 
 def unregister():
     bpy.utils.unregister_class(DATAMOSH_PT_panel)
+    bpy.utils.unregister_class(DatamoshVariant)
     del bpy.types.Scene.datamosh_start_frames
     del bpy.types.Scene.datamosh_start_points
     del bpy.types.Scene.datamosh_end_points
+    del bpy.types.Scene.datamosh_duplicated_p_frames
+    del bpy.types.Scene.datamosh_native_bitrate
+    del bpy.types.Scene.datamosh_native_gop
+    del bpy.types.Scene.datamosh_convert_workers
+    del bpy.types.Scene.datamosh_alias_duplicates
+    del bpy.types.Scene.datamosh_variants
+    del bpy.types.Scene.datamosh_use_variants
+    del bpy.types.Scene.datamosh_windows_only
+    del bpy.types.Scene.datamosh_preview_scale
+    del bpy.types.Scene.datamosh_preview_quantizer
+    del bpy.types.Scene.datamosh_use_cache
+    del bpy.types.Scene.datamosh_cache_dir
+    del bpy.types.Scene.datamosh_cache_budget
+    del bpy.types.Scene.datamosh_show_progress
+    del bpy.types.Scene.datamosh_checkpoint_interval
+    del bpy.types.Scene.datamosh_log_level
+    del bpy.types.Scene.datamosh_trace_memory
+    del bpy.types.Scene.datamosh_save_report
 
 if __name__ == "__main__":
     register()
\ No newline at end of file
@@ -0,0 +1,160 @@
+#############################################################################
+# Datamosh addon for blender                                                #
+# Copyright (C) 2025 Dan Argust                                             #
+#                                                                           #
+#    This program is free software: you can redistribute it and/or modify   #
+#    it under the terms of the GNU General Public License as published by   #
+#    the Free Software Foundation, either version 3 of the License, or      #
+#    (at your option) any later version.                                    #
+#                                                                           #
+#    This program is distributed in the hope that it will be useful,        #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of         #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the          #
+#    GNU General Public License for more details.                           #
+#                                                                           #
+#    You should have received a copy of the GNU General Public License      #
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>. #
+#############################################################################
+
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
+import os
+import subprocess
+import threading
+try:
+    from .parse_raw_avi import run_ffmpeg, xvid_args, extract_avi_data
+    from .avi_writer import AviWriter
+except ImportError:
+    from parse_raw_avi import run_ffmpeg, xvid_args, extract_avi_data
+    from avi_writer import AviWriter
+
+# Shorter segments cost more in ffmpeg start-up than they save
+MIN_SEGMENT_FRAMES = 250
+
+class _Stopped(Exception):
+    pass
+
+def probe_video(input_file):
+    """Sorted frame and keyframe timestamps of the first video stream.
+
+    Only packets are read, nothing is decoded.
+    """
+    cmd = ["ffprobe", "-v", "error", "-select_streams", "v:0", "-show_entries", "packet=pts_time,flags", "-of", "csv=p=0", input_file]
+    result = subprocess.run(cmd, capture_output=True, text=True, check=True)
+    frame_times = []
+    keyframe_times = []
+    for line in result.stdout.splitlines():
+        pts_time, _, flags = line.partition(",")
+        if pts_time in ("", "N/A"):
+            continue
+        frame_times.append(float(pts_time))
+        if "K" in flags:
+            keyframe_times.append(float(pts_time))
+    frame_times.sort()
+    keyframe_times.sort()
+    return frame_times, keyframe_times
+
+def plan_segments(frame_times, keyframe_times, count):
+    """Split the frames into at most count [first, last) ranges that start on keyframes."""
+    frame_count = len(frame_times)
+    keyframes = [bisect_left(frame_times, t) for t in keyframe_times]
+    bounds = [0]
+    for k in range(1, count):
+        j = bisect_left(keyframes, frame_count * k // count)
+        if j < len(keyframes) and keyframes[j] - bounds[-1] >= MIN_SEGMENT_FRAMES and frame_count - keyframes[j] >= MIN_SEGMENT_FRAMES:
+            bounds.append(keyframes[j])
+    bounds.append(frame_count)
+    return list(zip(bounds, bounds[1:]))
+
+def segment_args(input_file, frame_times, first, last, compression, threads, scale=None):
+    args = []
+    if first > 0:
+        # Seek to halfway between the previous frame and the first one so the
+        # accurate seek keeps exactly frame `first` onwards
+        start_time = (frame_times[first - 1] + frame_times[first]) / 2 - frame_times[0]
+        args += ["-ss", f"{start_time:.6f}"]
+    args += ["-i", input_file, "-frames:v", str(last - first), "-threads", str(threads)]
+    return args + xvid_args(compression, scale)
+
+def convert_to_avi_parallel(input_file, output_file, compression=3, workers=0, progress=None, scale=None):
+    """Encode keyframe-aligned segments of input_file concurrently and join them.
+
+    workers is the number of ffmpeg processes, 0 uses one per CPU. Falls
+    back to a single pass when ffprobe is unavailable or the input is too
+    short to split.
+    """
+    workers = workers or os.cpu_count() or 1
+    try:
+        frame_times, keyframe_times = probe_video(input_file)
+    except (OSError, subprocess.CalledProcessError) as e:
+        print(f"ffprobe failed ({e}), converting in a single pass")
+        frame_times, keyframe_times = [], []
+    segments = plan_segments(frame_times, keyframe_times, workers)
+    frame_count = len(frame_times)
+    if len(segments) <= 1:
+        on_frame = None
+        if progress is not None:
+            on_frame = lambda frame: progress(frame / frame_count if frame_count else frame)
+        run_ffmpeg(["-i", input_file] + xvid_args(compression, scale), output_file, on_frame)
+        return
+
+    print(f"Converting {frame_count} frames in {len(segments)} segments")
+    threads = max(1, (os.cpu_count() or 1) // len(segments))
+    # Named like cache partials so the cache sweeps them up if this process dies
+    base = os.path.splitext(output_file)[0]
+    if base.endswith(".partial"):
+        base = base[:-len(".partial")]
+    segment_files = [f"{base}_seg{k:03d}.partial.avi" for k in range(len(segments))]
+    done_frames = [0] * len(segments)
+    stop = threading.Event()
+
+    def encode(k):
+        first, last = segments[k]
+        def on_frame(frame):
+            if stop.is_set():
+                raise _Stopped()
+            done_frames[k] = frame
+        run_ffmpeg(segment_args(input_file, frame_times, first, last, compression, threads, scale), segment_files[k], on_frame)
+
+    try:
+        with ThreadPoolExecutor(len(segments)) as pool:
+            pending = {pool.submit(encode, k) for k in range(len(segments))}
+            try:
+                while pending:
+                    done, pending = wait(pending, timeout=0.25, return_when=FIRST_EXCEPTION)
+                    for future in done:
+                        future.result()
+                    if progress is not None:
+                        progress(sum(done_frames) / frame_count)
+            except BaseException:
+                # Make the other ffmpeg processes exit before leaving the pool
+                stop.set()
+                raise
+        join_avi_segments(segment_files, output_file)
+    finally:
+        for filename in segment_files:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+def join_avi_segments(segment_files, output_file):
+    """Concatenate AVI segments with identical stream layouts, rebuilding idx1.
+
+    The headers come from the first segment with their sizes and frame
+    counts back-patched, frame data is copied kernel-side where possible.
+    """
+    indexes = []
+    try:
+        for filename in segment_files:
+            # The segments are removed afterwards, so no sidecar is worth writing
+            indexes.append(extract_avi_data(filename, use_sidecar=False))
+        writer = AviWriter(output_file, indexes[0])
+        try:
+            for index in indexes:
+                writer.copy_frames(0, index.frame_count, index)
+            writer.finish()
+        except BaseException:
+            writer.abort()
+            raise
+    finally:
+        for index in indexes:
+            index.close()
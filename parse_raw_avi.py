@@ -16,38 +16,258 @@
 #    along with this program.  If not, see <https://www.gnu.org/licenses/>. #
 #############################################################################
 
-from enum import Enum
+from array import array
+from bisect import bisect_left
+import json
+import mmap
+import os
 import struct
 import subprocess
+import sys
+try:
+    from .avi_writer import AviWriter, AVIIF_KEYFRAME, AVI_INDEX_OF_INDEXES, ODML_NOT_KEYFRAME
+    from .frame_table import FrameTable, VopType
+    from .mosh_plan import as_frame_list, compile_mosh_plan, load_cached_plan, save_cached_plan, merge_windows
+    from .riff import walk_chunks, find_chunk
+    from .vop import classify_vops
+except ImportError:
+    from avi_writer import AviWriter, AVIIF_KEYFRAME, AVI_INDEX_OF_INDEXES, ODML_NOT_KEYFRAME
+    from frame_table import FrameTable, VopType
+    from mosh_plan import as_frame_list, compile_mosh_plan, load_cached_plan, save_cached_plan, merge_windows
+    from riff import walk_chunks, find_chunk
+    from vop import classify_vops
+# 0 prints a summary per step, 1 or more adds a line per frame or op
 debug_global = 0
 
+def run_ffmpeg(args, output_file, on_frame=None):
+    """Run ffmpeg with an argument list (never through a shell).
+
+    on_frame is called with each frame number ffmpeg reports through
+    -progress. If it raises, ffmpeg is killed, the partial output removed
+    and the exception re-raised.
+    """
+    cmd = ["ffmpeg", "-nostdin", "-y"] + args
+    if on_frame is None:
+        process = subprocess.run(cmd + [output_file])
+    else:
+        process = subprocess.Popen(cmd + ["-progress", "pipe:1", "-nostats", output_file], stdout=subprocess.PIPE, text=True)
+        try:
+            for line in process.stdout:
+                key, _, value = line.strip().partition("=")
+                if key == "frame" and value.isdigit():
+                    on_frame(int(value))
+            process.wait()
+        except BaseException:
+            process.kill()
+            process.wait()
+            if os.path.exists(output_file):
+                os.remove(output_file)
+            raise
+    if process.returncode != 0:
+        if os.path.exists(output_file):
+            os.remove(output_file)
+        raise RuntimeError(f"ffmpeg failed with exit code {process.returncode}")
+
+def xvid_args(compression, scale=None):
+    """ffmpeg output options for the Xvid conversion, scale (0-1) downsizes it for previews."""
+    args = []
+    if scale is not None:
+        # Xvid needs even dimensions
+        args += ["-vf", f"scale=trunc(iw*{scale}/2)*2:trunc(ih*{scale}/2)*2"]
+    return args + ["-c:v", "libxvid", "-q:v", str(compression), "-an"]
+
 # Convert to AVI (Xvid is best for datamoshing)
-def convert_to_avi(input_file, output_file, compression=3):
-    cmd = f'ffmpeg -i "{input_file}" -y -c:v libxvid -q:v {compression} -an "{output_file}"'
-    subprocess.run(cmd, shell=True)
+def convert_to_avi(input_file, output_file, compression=3, progress=None, total_frames=None, workers=1, start_frame=0, frame_count=None, fps=None, scale=None):
+    """Run ffmpeg to produce an Xvid AVI.
+
+    progress is called with the completed fraction (or the frame number if
+    total_frames is unknown) as ffmpeg reports it, raising from it cancels
+    the conversion. With workers > 1 the input is split at keyframes and the
+    segments are encoded concurrently, see parallel_convert. start_frame and
+    frame_count convert only part of the input, seeking needs fps. scale
+    shrinks the frames, e.g. 0.25 for a quick preview.
+    """
+    if workers != 1 and not (start_frame or frame_count):
+        try:
+            from .parallel_convert import convert_to_avi_parallel
+        except ImportError:
+            from parallel_convert import convert_to_avi_parallel
+        convert_to_avi_parallel(input_file, output_file, compression, workers, progress, scale)
+        return
+    args = []
+    if start_frame:
+        # Half a frame early so the accurate seek keeps start_frame itself
+        args += ["-ss", f"{(start_frame - 0.5) / fps:.6f}"]
+    args += ["-i", input_file]
+    if frame_count:
+        args += ["-frames:v", str(frame_count)]
+    on_frame = None
+    if progress is not None:
+        on_frame = lambda frame: progress(frame / total_frames if total_frames else frame)
+    run_ffmpeg(args + xvid_args(compression, scale), output_file, on_frame)
+
+class AviIndex:
+    """Offsets, sizes and frame types of an AVI file, backed by a read-only mmap.
+
+    Nothing but the header fields is copied out of the file; view() and
+    frame_view() hand out zero-copy memoryviews into the mapping. Close the
+    index (or use it as a context manager) before deleting the file.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = open(filename, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._map)
+        self.sections = {}
+        # Bytes read to build the index, the file itself or its sidecar
+        self.bytes_read = 0
+
+    def __getitem__(self, key):
+        return self.sections[key]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def data(self):
+        return self._map
+
+    @property
+    def frames(self):
+        return self.sections["movi"]["frame_data"]
+
+    @property
+    def frame_count(self):
+        return len(self.frames)
+
+    def view(self, start, end):
+        return self._view[start:end]
+
+    def fileno(self):
+        return self._file.fileno()
+
+    def segment_end(self, i):
+        """Index of the first frame after frame i that is in another RIFF segment's movi list."""
+        for riff in self.sections.get("riffs", ()):
+            if riff["first_frame"] > i:
+                return riff["first_frame"]
+        return self.frame_count
 
-class FrameType(Enum):
-    UncompressedVideoFrame = b'db'
-    CompressedVideoFrame = b'dc'
-    PaletteChange = b'pc'
-    AudioData = b'wb'
+    def frame_span(self, i):
+        """Byte range of frame i up to the next frame, including padding.
 
-    # I-frames
-    I = b'\xb0'
-    P = b'\xb6'
+        The last frame of a movi list ends with its own chunk, so the
+        indexes and RIFF headers that follow are never part of a span.
+        """
+        starts = self.frames.starts
+        # An aliased entry shares its chunk with the frame before it
+        if i + 1 < self.segment_end(i) and starts[i + 1] > starts[i]:
+            return starts[i], starts[i + 1]
+        size = self.frames.sizes[i]
+        return starts[i], starts[i] + 8 + size + (size & 1)
+
+    def frame_view(self, i):
+        start = self.frames.starts[i]
+        return self._view[start:start + self.frames.sizes[i] + 8]
+
+    def idx1_entries(self):
+        idx1 = self.sections["idx1"]
+        if idx1["start"] is None:
+            return iter(())
+        entries = self._view[idx1["start"] + 8:idx1["end"]]
+        return struct.iter_unpack("<4sIII", entries)
+
+    def close(self):
+        if self._map is None:
+            return
+        self._view.release()
+        self._map.close()
+        self._file.close()
+        self._map = None
+
+def collect_riff_segments(avi_data):
+    """The top level RIFF lists, 'AVI ' followed by any OpenDML 'AVIX' extensions.
+
+    Only their direct children are walked, just far enough to find the movi lists.
+    """
+    riffs = []
+    for chunk in walk_chunks(avi_data, max_depth=1):
+        if chunk.depth == 0:
+            if chunk.fourcc != b"RIFF":
+                break
+            riff = {"start": chunk.start, "size": chunk.size, "type": chunk.list_type.decode("latin-1"), "movi_start": None, "movi_end": None}
+            riffs.append(riff)
+        elif chunk.list_type == b"movi" and riff["movi_start"] is None:
+            riff["movi_start"] = chunk.start + 8
+            riff["movi_end"] = min(chunk.start + 8 + chunk.size, riff["start"] + 8 + riff["size"], len(avi_data))
+    return riffs
+
+def collect_header_chunks(avi_data):
+    """The first chunk of each kind in the first RIFF, keyed by fourcc or list type.
+
+    The movi list is stepped over, so this takes a few dozen hops however
+    long the file is.
+    """
+    chunks = {}
+    for chunk in walk_chunks(avi_data, skip=(b"movi",)):
+        if chunk.depth == 0 and chunk.start > 0:
+            break
+        chunks.setdefault(chunk.list_type or chunk.fourcc, chunk)
+    return chunks
+
+def chunk_section(chunks, key):
+    """Start and size of one of the collect_header_chunks chunks.
+
+    Lists start at their list type, where idx1 offsets count from for movi.
+    """
+    chunk = chunks.get(key)
+    if chunk is None:
+        raise ValueError(f"AVI file has no {key.decode('latin-1')} chunk")
+    return {"start": chunk.start + 8 if chunk.list_type is not None else chunk.start, "size": chunk.size}
+
+def collect_super_index(avi_data, strl):
+    """The OpenDML indx of the video stream, None for an AVI 1.0 file."""
+    indx = find_chunk(avi_data, b"indx", strl["start"] + 4, strl["start"] + strl["size"], max_depth=0)
+    if indx is None:
+        return None
+    indx_start, indx_size = indx.start, indx.size
+    longs_per_entry, sub_type, index_type, entry_count, chunk_id = struct.unpack_from("<HBBI4s", avi_data, indx_start + 8)
+    if index_type != AVI_INDEX_OF_INDEXES or entry_count == 0:
+        return None
+    # Entries are (standard index offset, its size, frames in it)
+    entries = avi_data[indx_start + 32:indx_start + 32 + 16 * entry_count]
+    return {"start": indx_start, "size": indx_size, "entries": [list(entry) for entry in struct.iter_unpack("<QII", entries)]}
+
+def collect_odml_frame_data(avi_data, super_index, progress=None):
+    # Frames of an OpenDML file come straight from its ix00 standard indexes,
+    # which hold 64-bit base offsets and cover every RIFF segment
+    frames = FrameTable()
+    entries = super_index["entries"]
+    for k, (ix_start, ix_size, duration) in enumerate(entries):
+        if progress:
+            progress(k / len(entries))
+        entry_count, chunk_id, base_offset = struct.unpack_from("<I4sQ", avi_data, ix_start + 12)
+        for offset, size in struct.iter_unpack("<II", avi_data[ix_start + 32:ix_start + 32 + 8 * entry_count]):
+            # Offsets point at the frame data, after the 8 byte chunk header
+            frame_start = base_offset + offset - 8
+            frames.starts.append(frame_start)
+            frames.sizes.append(size & ~ODML_NOT_KEYFRAME)
+            frames.flags.append(0 if size & ODML_NOT_KEYFRAME else AVIIF_KEYFRAME)
+    return frames
 
 def collect_riff_data(avi_data):
     riff_start = avi_data.find(b"RIFF")
     riff_size = int.from_bytes(avi_data[riff_start + 4:riff_start + 8], "little")
-    riff_data = avi_data[riff_start:riff_start + riff_size + 8]
     fileSize = int.from_bytes(avi_data[4:8], "little")
     fileType = avi_data[8:12].decode("utf-8")
-    return {"start": riff_start, "size": riff_size, "data": riff_data, "fileSize": fileSize, "fileType": fileType}
+    return {"start": riff_start, "size": riff_size, "fileSize": fileSize, "fileType": fileType}
 
-def collect_avih_data(avi_data, hdrl_start):
-    avih_start = avi_data.find(b"avih", hdrl_start)
+def collect_avih_data(avi_data, avih_start):
     avih_size = int.from_bytes(avi_data[avih_start + 4:avih_start + 8], "little")
-    avih_data = avi_data[avih_start:avih_start + avih_size + 8]
     microsec_per_frame = int.from_bytes(avi_data[avih_start + 8:avih_start + 12], "little")
     max_bytes_per_sec = int.from_bytes(avi_data[avih_start + 12:avih_start + 16], "little")
     padding_granularity = int.from_bytes(avi_data[avih_start + 16:avih_start + 20], "little")
@@ -59,207 +279,406 @@ def collect_avih_data(avi_data, hdrl_start):
     width = int.from_bytes(avi_data[avih_start + 40:avih_start + 44], "little")
     height = int.from_bytes(avi_data[avih_start + 44:avih_start + 48], "little")
     reserved = int.from_bytes(avi_data[avih_start + 48:avih_start + 52], "little")
-    return {"start": avih_start, "size": avih_size, "data": avih_data, "microsec_per_frame": microsec_per_frame, "max_bytes_per_sec": max_bytes_per_sec, "padding_granularity": padding_granularity, "flags": flags, "total_frames": total_frames, "initial_frames": initial_frames, "streams": streams, "suggested_buffer_size": suggested_buffer_size, "width": width, "height": height, "reserved": reserved}
-
-def collect_strl_data(avi_data, hdrl_start):
-    strl_start = avi_data.find(b"strl", hdrl_start)
-    strl_size = int.from_bytes(avi_data[strl_start + 4:strl_start + 8], "little")
-    strl_data = avi_data[strl_start:strl_start + strl_size + 8]
-    return {"start": strl_start, "size": strl_size, "data": strl_data}
-
-def collect_strh_data(avi_data, hdrl_start):
-    strh_start = avi_data.find(b"strh", hdrl_start)
-    strh_size = int.from_bytes(avi_data[strh_start + 4:strh_start + 8], "little")
-    strh_data = avi_data[strh_start:strh_start + strh_size + 8]
-    return {"start": strh_start, "size": strh_size, "data": strh_data}
-
-def collect_strf_data(avi_data, hdrl_start):
-    strf_start = avi_data.find(b"strf", hdrl_start)
-    strf_size = int.from_bytes(avi_data[strf_start + 4:strf_start + 8], "little")
-    strf_data = avi_data[strf_start:strf_start + strf_size + 8]
-    return {"start": strf_start, "size": strf_size, "data": strf_data}
-
-def collect_hdrl_data(avi_data):
-    hdrl_start = avi_data.find(b"hdrl")
-    hdrl_size = int.from_bytes(avi_data[hdrl_start + 4:hdrl_start + 8], "little")
-    hdrl_data = avi_data[hdrl_start:hdrl_start + hdrl_size + 8]
-    avih_data = collect_avih_data(avi_data, hdrl_start)
-    strl_data = collect_strl_data(avi_data, hdrl_start)
-    strh_data = collect_strh_data(avi_data, hdrl_start)
-    strf_data = collect_strf_data(avi_data, hdrl_start)
-    return {"start": hdrl_start, "size": hdrl_size, "data": hdrl_data, "avih": avih_data, "strl": strl_data, "strh": strh_data, "strf": strf_data}
-
-def collect_frame_data(avi_data, movi_start, total_frames):
-    #global debug_global
-    frame_data = []
-    frame_types = []
-    for i in range(total_frames):
-        frame_start = avi_data.find(b"00dc", movi_start)
-        frame_size = int.from_bytes(avi_data[frame_start + 4:frame_start + 8], "little")
-        frame_data.append({"start": frame_start, "size": frame_size, "data": avi_data[frame_start:frame_start + frame_size + 8]})
-        # Work out if the frame is an I frame or a B/P frame
-        frame_type = avi_data[frame_start + 11:frame_start + 12]
-        frame_types.append(frame_type)
-        #if debug_global == 3:
-        #    print(f"frame type: {frame_type}")
-        #debug_global += 1
-        movi_start = frame_start + frame_size
-        
-    return {"frame_data": frame_data, "frame_types": frame_types}
-    
-def collect_movi_data(avi_data, total_frames):
-    movi_start = avi_data.find(b"movi")
-    movi_size = int.from_bytes(avi_data[movi_start + 4:movi_start + 8], "little")
-    movi_data = avi_data[movi_start:movi_start + movi_size + 8]
-    frame_data = collect_frame_data(avi_data, movi_start, total_frames)
-    return {"start": movi_start, "size": movi_size, "data": movi_data, "frame_data": frame_data}
-
-def collect_idx1_data(avi_data):
-    idx1_start = avi_data.find(b"idx1")
-    idx1_size = int.from_bytes(avi_data[idx1_start + 4:idx1_start + 8], "little")
-    idx1_data = avi_data[idx1_start:idx1_start + idx1_size + 8]
-    idx1_entries = []
+    return {"start": avih_start, "size": avih_size, "microsec_per_frame": microsec_per_frame, "max_bytes_per_sec": max_bytes_per_sec, "padding_granularity": padding_granularity, "flags": flags, "total_frames": total_frames, "initial_frames": initial_frames, "streams": streams, "suggested_buffer_size": suggested_buffer_size, "width": width, "height": height, "reserved": reserved}
+
+def collect_hdrl_data(avi_data, chunks=None):
+    # The first strl is the video stream's
+    chunks = chunks or collect_header_chunks(avi_data)
+    hdrl_data = chunk_section(chunks, b"hdrl")
+    hdrl_data["avih"] = collect_avih_data(avi_data, chunk_section(chunks, b"avih")["start"])
+    for key in (b"strl", b"strh", b"strf"):
+        hdrl_data[key.decode()] = chunk_section(chunks, key)
+    hdrl_data["dmlh"] = chunk_section(chunks, b"dmlh") if b"dmlh" in chunks else None
+    return hdrl_data
+
+# Chunks of the first (video) stream
+VIDEO_FOURCCS = (b"00dc", b"00db")
+
+def collect_frame_data(avi_data, movi_start, movi_end, progress=None, frames=None):
+    # Only offsets and sizes are kept, the payloads stay in the file; types are filled in by classify_vops
+    # Given the frames already known (e.g. before the file was appended to), only the rest is walked
+    if frames is None:
+        frames = FrameTable()
+    walk_start = movi_start + 4
+    if len(frames):
+        last_size = frames.sizes[-1]
+        walk_start = frames.starts[-1] + 8 + last_size + (last_size & 1)
+    movi_size = max(movi_end - movi_start, 1)
+    # JUNK, audio and ix00 chunks are stepped over, LIST rec is walked into
+    for chunk in walk_chunks(avi_data, walk_start, movi_end):
+        if chunk.fourcc not in VIDEO_FOURCCS:
+            continue
+        if progress and len(frames) % 4096 == 0:
+            progress((chunk.start - movi_start) / movi_size)
+        frames.starts.append(chunk.start)
+        frames.sizes.append(chunk.size)
+    return frames
+
+def collect_frame_flags(index):
+    # idx1 flags of the video frames, in frame order
+    frames = index.frames
+    frames.flags = array("I")
+    for chunk_id, flags, offset, size in index.idx1_entries():
+        if chunk_id[:2] == b"00" and chunk_id[2:] in (b"dc", b"db"):
+            frames.flags.append(flags)
+    if len(frames.flags) != len(frames):
+        frames.flags = array("I", (AVIIF_KEYFRAME if t == VopType.I else 0 for t in frames.types))
+
+def collect_strf_extradata(avi_data, strf):
+    # Codec headers stored after the BITMAPINFOHEADER, such as the VOL of a stream muxed with a global header
+    payload_start = strf["start"] + 8
+    header_size = int.from_bytes(avi_data[payload_start:payload_start + 4], "little")
+    return bytes(avi_data[payload_start + header_size:payload_start + strf["size"]])
+
+def collect_movi_data(avi_data, progress=None, frames=None, chunks=None):
+    movi_data = chunk_section(chunks or collect_header_chunks(avi_data), b"movi")
+    movi_end = min(movi_data["start"] + movi_data["size"], len(avi_data))
+    movi_data["frame_data"] = collect_frame_data(avi_data, movi_data["start"], movi_end, progress, frames)
+    return movi_data
+
+def collect_idx1_data(avi_data, chunks=None):
+    idx1 = (chunks or collect_header_chunks(avi_data)).get(b"idx1")
+    if idx1 is None:
+        return {"start": None, "size": 0, "count": 0, "end": None}
+    idx1_start, idx1_size = idx1.start, idx1.size
     entry_size = 16  # Each idx1 entry is 16 bytes long
-    idx1_end = 0
-    for i in range(0, idx1_size, entry_size):
-        entry_start = idx1_start + 8 + i
-        chunk_id = avi_data[entry_start:entry_start + 4]
-        flags = int.from_bytes(avi_data[entry_start + 4:entry_start + 8], "little")
-        offset = int.from_bytes(avi_data[entry_start + 8:entry_start + 12], "little")
-        size = int.from_bytes(avi_data[entry_start + 12:entry_start + 16], "little")
-        idx1_entries.append({"chunk_id": chunk_id, "flags": flags, "offset": offset, "size": size})
-        idx1_end = entry_start + entry_size
-    return {"start": idx1_start, "size": idx1_size, "data": idx1_data, "entries": idx1_entries, "end": idx1_end}
-
-def extract_avi_data(input_file):
-    with open(input_file, "rb") as f_in:
-        avi_data = f_in.read()
-
-        riff_data = collect_riff_data(avi_data)
-        print(f"riff start: {riff_data['start']}, size: {riff_data['size']}")
-        print(f"    file size: {riff_data['fileSize']}")
-        print(f"    file type: {riff_data['fileType']}")
-
-        hdrl_data = collect_hdrl_data(avi_data)
-        total_frames = hdrl_data["avih"]["total_frames"]
-        print(f"hdrl start: {hdrl_data['start']}, size: {hdrl_data['size']}")
-        print(f"    total frames: {total_frames}")
-        print(f"    video dimensions: {hdrl_data['avih']['width']}x{hdrl_data['avih']['height']}")
-
-        movi_data = collect_movi_data(avi_data, total_frames)
-        print(f"movi start: {movi_data['start']}, size: {movi_data['size']}")
-        print("    number of I frames: {}".format(movi_data['frame_data']['frame_types'].count(b'\xb0')))
-        print("    number of P frames: {}".format(movi_data['frame_data']['frame_types'].count(b'\xb6')))
-        i = 0
-        for frame in movi_data['frame_data']['frame_data']:
-            if i < 3:
-                print(f"        frame start: {frame['start']}, size: {frame['size']}")
-            i += 1
-        if i > 3:
-            print("        ...")
+    entry_count = idx1_size // entry_size
+    idx1_end = idx1_start + 8 + entry_count * entry_size
+    return {"start": idx1_start, "size": idx1_size, "count": entry_count, "end": idx1_end}
+
+def extract_avi_data(input_file, progress=None, use_sidecar=True):
+    """Parse input_file into an AviIndex.
+
+    With use_sidecar the parsed index is saved next to the file and loaded
+    from there on later calls while the file is unchanged, see
+    load_index_sidecar.
+    """
+    if use_sidecar:
+        index = load_index_sidecar(input_file, progress)
+        if index is not None:
+            return index
+    index = AviIndex(input_file)
+    parse_avi_index(index, progress)
+    index.bytes_read = len(index.data)
+    if use_sidecar:
+        save_index_sidecar(index)
+    return index
+
+def parse_avi_index(index, progress=None, frames=None):
+    avi_data = index.data
+
+    riff_data = collect_riff_data(avi_data)
+    print(f"riff start: {riff_data['start']}, size: {riff_data['size']}")
+    print(f"    file size: {riff_data['fileSize']}")
+    print(f"    file type: {riff_data['fileType']}")
 
-        idx1_data = collect_idx1_data(avi_data)
-        print(f"idx1 start: {idx1_data['start']}, size: {idx1_data['size']}")
-        i = 0
-        for entry in idx1_data['entries']:
-            if i < 3:
-                print(f"        chunk id: {entry['chunk_id']}, offset: {entry['offset']}, size: {entry['size']}")
-            i += 1
-        if i > 3:
+    chunks = collect_header_chunks(avi_data)
+    hdrl_data = collect_hdrl_data(avi_data, chunks)
+    total_frames = hdrl_data["avih"]["total_frames"]
+    print(f"hdrl start: {hdrl_data['start']}, size: {hdrl_data['size']}")
+    print(f"    total frames: {total_frames}")
+    print(f"    video dimensions: {hdrl_data['avih']['width']}x{hdrl_data['avih']['height']}")
+
+    riffs = collect_riff_segments(avi_data)
+    super_index = collect_super_index(avi_data, hdrl_data["strl"])
+    if super_index is not None:
+        # OpenDML: avih only counts the frames of the first RIFF
+        print(f"OpenDML file with {len(riffs)} RIFF segments, {len(super_index['entries'])} standard indexes")
+        frames = collect_odml_frame_data(avi_data, super_index, progress)
+        movi_start = riffs[0]["movi_start"]
+        movi_data = {"start": movi_start, "size": riffs[0]["movi_end"] - movi_start, "frame_data": frames}
+    else:
+        movi_data = collect_movi_data(avi_data, progress, frames, chunks)
+        frames = movi_data["frame_data"]
+    # The frames' VOP headers are decoded in one pass once they are all known
+    frames.types += classify_vops(avi_data, frames, len(frames.types), collect_strf_extradata(avi_data, hdrl_data["strf"]))
+    for riff in riffs:
+        riff["first_frame"] = bisect_left(frames.starts, riff["movi_start"] or len(avi_data))
+    print(f"movi start: {movi_data['start']}, size: {movi_data['size']}")
+    print("    number of I frames: {}".format(frames.types.count(VopType.I)))
+    print("    number of P frames: {}".format(frames.types.count(VopType.P)))
+    for vop_type in (VopType.B, VopType.S, VopType.N, VopType.UNKNOWN):
+        if vop_type in frames.types:
+            print(f"    number of {vop_type.name} frames: {frames.types.count(vop_type)}")
+    if debug_global:
+        for i in range(min(3, len(frames))):
+            print(f"        frame start: {frames.starts[i]}, size: {frames.sizes[i]}")
+        if len(frames) > 3:
             print("        ...")
 
-    return {"riff": riff_data, "hdrl": hdrl_data, "movi": movi_data, "idx1": idx1_data}
+    idx1_data = collect_idx1_data(avi_data, chunks)
+    print(f"idx1 start: {idx1_data['start']}, size: {idx1_data['size']}")
+
+    index.sections = {"riff": riff_data, "hdrl": hdrl_data, "movi": movi_data, "idx1": idx1_data, "riffs": riffs, "indx": super_index}
+    if super_index is None:
+        collect_frame_flags(index)
+    if debug_global:
+        for i, (chunk_id, flags, offset, size) in enumerate(index.idx1_entries()):
+            if i == 3:
+                print("        ...")
+                break
+            print(f"        chunk id: {chunk_id}, offset: {offset}, size: {size}")
+
+SIDECAR_MAGIC = b"DMIX"
+SIDECAR_VERSION = 4
+SIDECAR_HEADER = struct.Struct("<4sIQQI")
+
+def sidecar_path(input_file):
+    return input_file + ".dmidx"
+
+def save_index_sidecar(index):
+    """Write the parsed index to a compact binary file next to the AVI.
+
+    Layout: SIDECAR_HEADER (magic, version, file size, mtime, JSON length),
+    the JSON encoded header sections, then the little-endian frame table
+    columns (starts, sizes, types, flags).
+    """
+    frames = index.frames
+    stat = os.stat(index.filename)
+    sections = {key: value for key, value in index.sections.items() if key != "movi"}
+    sections["movi"] = {key: value for key, value in index["movi"].items() if key != "frame_data"}
+    # The header of the last frame must still be in place for an appended file to be rescanned
+    last_frame = bytes(index.frame_view(len(frames) - 1)[:8]).hex() if len(frames) else ""
+    header_json = json.dumps({"sections": sections, "frame_count": len(frames), "last_frame": last_frame}).encode()
+    columns = [frames.starts, frames.sizes, frames.flags]
+    if sys.byteorder != "little":
+        columns = [array(column.typecode, column) for column in columns]
+        for column in columns:
+            column.byteswap()
+    try:
+        with open(sidecar_path(index.filename), "wb") as f:
+            f.write(SIDECAR_HEADER.pack(SIDECAR_MAGIC, SIDECAR_VERSION, stat.st_size, stat.st_mtime_ns, len(header_json)))
+            f.write(header_json)
+            f.write(columns[0])
+            f.write(columns[1])
+            f.write(frames.types)
+            f.write(columns[2])
+    except OSError as e:
+        # A read-only directory only costs the next run a full parse
+        print(f"Could not write index sidecar: {e}")
+
+def load_index_sidecar(input_file, progress=None):
+    """AviIndex for input_file from its sidecar, or None if there is no usable sidecar.
 
-def create_datamoshed_avi(avi_data, input_filename, output_filename, start_at=2, end_at=1000, duplicated_p_frames=1, transition_frames=None):
+    The sidecar is used as is when the file size and mtime match. If the
+    file has only grown and the last known frame is still in place, just
+    the headers, the new frames and idx1 are parsed again.
+    """
+    try:
+        with open(sidecar_path(input_file), "rb") as f:
+            magic, version, file_size, mtime_ns, json_size = SIDECAR_HEADER.unpack(f.read(SIDECAR_HEADER.size))
+            if magic != SIDECAR_MAGIC or version != SIDECAR_VERSION:
+                return None
+            stat = os.stat(input_file)
+            unchanged = stat.st_size == file_size and stat.st_mtime_ns == mtime_ns
+            if not unchanged and stat.st_size <= file_size:
+                return None
+            header = json.loads(f.read(json_size))
+            frame_count = header["frame_count"]
+            frames = FrameTable()
+            frames.starts.frombytes(f.read(8 * frame_count))
+            frames.sizes.frombytes(f.read(4 * frame_count))
+            frames.types = bytearray(f.read(frame_count))
+            frames.flags.frombytes(f.read(4 * frame_count))
+    except (OSError, ValueError, KeyError, struct.error):
+        return None
+    if len(frames.flags) != frame_count or len(frames.types) != frame_count:
+        return None
+    if sys.byteorder != "little":
+        for column in (frames.starts, frames.sizes, frames.flags):
+            column.byteswap()
+
+    index = AviIndex(input_file)
+    # 8 + 4 + 1 + 4 bytes of columns per frame
+    index.bytes_read = SIDECAR_HEADER.size + json_size + 17 * frame_count
+    if unchanged:
+        index.sections = header["sections"]
+        index.sections["movi"]["frame_data"] = frames
+        return index
+    if frame_count and bytes(index.view(frames.starts[-1], frames.starts[-1] + 8)).hex() != header["last_frame"]:
+        index.close()
+        return None
+    print(f"{input_file} was appended to, scanning from frame {frame_count}")
+    parse_avi_index(index, progress, frames)
+    index.bytes_read += stat.st_size - file_size
+    save_index_sidecar(index)
+    return index
+
+def run_mosh_op(writer, op, first=0, last=None, chunk=None, data=None):
+    """Execute one MoshPlan op with writer.
+
+    A copy op is clipped to the source frames first..last-1 and written
+    from chunk if one is given, see AviWriter.copy_frames(). data is the
+    span of the source P-frame of a dup or alias op if already read.
+    """
+    if op[0] == "copy":
+        writer.copy_frames(max(op[1], first), op[2] if last is None else min(op[2], last), chunk=chunk)
+    elif op[0] == "drop":
+        if debug_global:
+            print(f"    explicitly skipping frames {op[1]} to {op[2] - 1} for transition...")
+    elif op[0] == "alias":
+        if debug_global:
+            print(f"    swapping I-frame at {op[1]}, indexing {op[3]} times")
+        position = writer.write_frame(op[2], data=data)
+        for j in range(op[3] - 1):
+            writer.alias_frame(op[2], position)
+    else:
+        if debug_global:
+            print(f"    swapping I-frame at {op[1]}")
+        for j in range(op[3]):
+            writer.write_frame(op[2], data=data)
+
+def write_mosh_plan(index, plan, output_filename, previous=None, progress=None, checkpoint_interval=None, on_checkpoint=None):
+    """Execute a compiled MoshPlan, streaming the result to output_filename.
+
+    If previous is the plan that produced the existing output_filename, the
+    output up to the first op where the plans differ is kept as it is and
+    only the rest of the file is rewritten. progress is called with the
+    fraction of the source file processed so far. With checkpoint_interval
+    the output is made playable every so many seconds, see
+    AviWriter.checkpoint(), calling on_checkpoint with the frames so far.
+    """
+    reused_ops = plan.common_prefix(previous) if previous is not None else 0
+    writer = AviWriter(output_filename, index, reuse_existing=reused_ops > 0)
+    writer.checkpoint_interval = checkpoint_interval
+    writer.on_checkpoint = on_checkpoint
+    if progress:
+        source_size = len(index.data)
+        writer.progress = lambda offset: progress(offset / source_size)
+    try:
+        for k, op in enumerate(plan.ops):
+            if k == reused_ops and writer.reusing:
+                print(f"    reusing first {writer.position} bytes of previous output")
+                writer.resume()
+            run_mosh_op(writer, op)
+        writer.finish()
+    except BaseException:
+        writer.abort()
+        raise
+    return writer
+
+# Source bytes read at a time when fanning out to several writers
+FANOUT_CHUNK = 16 << 20
+
+def create_datamoshed_avis(index, variants, progress=None):
+    """Write several datamoshed versions of one source in a single pass over it.
+
+    variants is a list of dicts with an "output" filename and the
+    create_datamoshed_avi parameters start_at, end_at, duplicated_p_frames,
+    transition_frames and alias_duplicates. Each chunk of the source is read once and handed
+    to every variant's writer, so reading costs the same for any number of
+    variants. Returns the totals with the per-variant counts under "variants".
+    """
+    plans = []
+    for variant in variants:
+        start_at = as_frame_list(variant["start_at"])
+        end_at = as_frame_list(variant["end_at"])
+        plans.append(compile_mosh_plan(index.frames, start_at, end_at, variant.get("transition_frames") or [], variant.get("duplicated_p_frames", 0), variant.get("alias_duplicates", False)))
+        print(f"Variant {variant['output']}: start points: {start_at}, end points: {end_at}, transitions: {variant.get('transition_frames')}")
+    # P-frames that stand in for I-frames are kept from when they were read until their last use
+    dup_uses = {}
+    for plan in plans:
+        for op in plan.ops:
+            if op[0] in ("dup", "alias"):
+                dup_uses[op[2]] = dup_uses.get(op[2], 0) + 1
+    dup_sources = sorted(dup_uses)
+    saved = {}
+
+    writers = []
+    try:
+        for variant in variants:
+            writers.append(AviWriter(variant["output"], index))
+        starts = index.frames.starts
+        frame_count = index.frame_count
+        cursors = [0] * len(plans)
+        bytes_read = 0
+        a = 0
+        while a < frame_count:
+            b = max(bisect_left(starts, starts[a] + FANOUT_CHUNK, a, frame_count), a + 1)
+            chunk_start = index.frame_span(a)[0]
+            chunk_end = index.frame_span(b - 1)[1]
+            # Released even when a writer fails, so the index can still be closed
+            with index.view(chunk_start, chunk_end) as view:
+                chunk = (chunk_start, view)
+                bytes_read += chunk_end - chunk_start
+                for source in dup_sources[bisect_left(dup_sources, a):bisect_left(dup_sources, b)]:
+                    start, end = index.frame_span(source)
+                    saved[source] = bytes(chunk[1][start - chunk_start:end - chunk_start])
+
+                for k, plan in enumerate(plans):
+                    writer = writers[k]
+                    while cursors[k] < len(plan.ops):
+                        op = plan.ops[cursors[k]]
+                        if op[1] >= b:
+                            break
+                        swap = op[0] in ("dup", "alias")
+                        run_mosh_op(writer, op, a, b, chunk, saved[op[2]] if swap else None)
+                        if op[0] == "copy" and op[2] > b:
+                            # The rest of the run is in the next chunk
+                            break
+                        if swap:
+                            dup_uses[op[2]] -= 1
+                            if dup_uses[op[2]] == 0:
+                                del saved[op[2]]
+                        cursors[k] += 1
+            if progress:
+                progress(chunk_end / len(index.data))
+            a = b
+
+        for writer in writers:
+            writer.finish()
+    except BaseException:
+        for writer in writers:
+            writer.abort()
+        raise
+
+    stats = []
+    for variant, plan, writer in zip(variants, plans, writers):
+        stats.append({"output": variant["output"], "frames": writer.frame_count, "swapped": plan.swapped_count, "dropped": plan.dropped_count, "bytes_written": writer.bytes_written})
+        print(f"#### Datamosh complete. Saved to: {variant['output']} ({writer.frame_count} frames)")
+    totals = {"bytes_read": bytes_read, "variants": stats}
+    for counter in ("frames", "swapped", "dropped", "bytes_written"):
+        totals[counter] = sum(variant_stats[counter] for variant_stats in stats)
+    return totals
+
+def create_datamoshed_avi(avi_data, input_filename, output_filename, start_at=2, end_at=1000, duplicated_p_frames=1, transition_frames=None, progress=None, alias_duplicates=False, checkpoint_interval=None, on_checkpoint=None):
+    """Write the datamoshed output, returning the frame and byte counts of the run.
+
+    With alias_duplicates each duplicated P-frame is stored once and indexed
+    duplicated_p_frames + 1 times, see AviWriter.alias_frame().
+    checkpoint_interval and on_checkpoint are passed to write_mosh_plan.
+    """
     print("#### Datamoshing AVI file...")
     print("removing I-frames and replacing them with duplicated P-frames...")
     print(f"start points: {start_at}, end points: {end_at}, transitions: {transition_frames}")
-    new_file_data = bytearray()
-    print_writes = False
-    with open(input_filename, "rb") as f_in:
-        raw_file_data = f_in.read()
-        riff_start = avi_data["riff"]["start"]
-        hdrl_start = avi_data["hdrl"]["start"]
-        movi_start = avi_data["movi"]["start"]
-        idx1_start = avi_data["idx1"]["start"]
-        # Don't modify the RIFF chunk
-        new_file_data.extend(raw_file_data[riff_start:hdrl_start])
-        if print_writes: print(f"writing riff from {riff_start} to {hdrl_start}")
-        # Don't modify the HDLR/AVIH chunk
-        new_file_data.extend(raw_file_data[hdrl_start:movi_start])
-        if print_writes: print(f"writing hdrl from {hdrl_start} to {movi_start}")
-        # Modify the MOVI chunk by removing I-frames and duplicating P-frames
-        modified_frame_starts = []
-        modified_frame_ends = []
-        first_frame_start = avi_data["movi"]["frame_data"]["frame_data"][0]["start"]
-        new_file_data.extend(raw_file_data[movi_start:first_frame_start])
-        if print_writes: print(f"writing movi from {movi_start} to {first_frame_start}")
-        frame_count = len(avi_data["movi"]["frame_data"]["frame_data"])
-        last_frame_binary = None
-        skipped_frames = 0
-        removing = False
-        for i in range(frame_count):
-            frame = avi_data["movi"]["frame_data"]["frame_data"][i]
-            frame_start = frame["start"]
-            next_frame_start = avi_data["movi"]["frame_data"]["frame_data"][i + 1]["start"] if i + 1 < frame_count else idx1_start
-            frame_type = avi_data["movi"]["frame_data"]["frame_types"][i]
-            raw_binary = raw_file_data[frame_start:next_frame_start]
-            if not i in transition_frames:
-                if any([(start_at[q] <= i <= end_at[q]) for q in range(len(start_at))]):
-                    if not removing:
-                        print(f"removing I-frames from frame {i}...")
-                    removing = True
-                    if frame_type == FrameType.I.value:
-                        print(f"    swapping I-frame at {i}")
-                        raw_binary = last_frame_binary
-                        new_file_data.extend(last_frame_binary)
-                        for j in range(duplicated_p_frames):
-                            new_file_data.extend(last_frame_binary)
-                            skipped_frames -= 1
-                    else:
-                        pass
-                        new_file_data.extend(raw_binary)
-                else:
-                    if removing:
-                        print(f"resuming I-frames at frame {i}")
-                    removing = False
-                    new_file_data.extend(raw_binary)
-            else:
-                print(f"    explicitly skipping frame {i} for transition...")
-                skipped_frames += 1
-            if print_writes: print(f"writing fram from {frame_start} to {next_frame_start}, type: {frame_type}")
-            if frame_type == FrameType.P.value:
-                last_frame_binary = raw_binary
-        new_file_data.extend(raw_file_data[next_frame_start:idx1_start])
-        if print_writes: print(f"writing mend from {next_frame_start} to {idx1_start}")
-
-        # Modify the IDX1 chunk by updating the index entries
-        for entry in avi_data["idx1"]["entries"]:
-            chunk_id = entry["chunk_id"]
-            flags = entry["flags"]
-            offset = entry["offset"]
-            size = entry["size"]
-            new_file_data.extend(chunk_id)
-            new_file_data.extend(struct.pack('<I', flags))
-            new_file_data.extend(struct.pack('<I', offset))
-            new_file_data.extend(struct.pack('<I', size))
-        new_file_data.extend(raw_file_data[avi_data["idx1"]["end"]:])
-
-        if print_writes: print(f"writing idx1 from {idx1_start} to end")
-    
-    new_frame_count = len(avi_data["movi"]["frame_data"]["frame_data"]) - skipped_frames
-    print(f"Old frame count: {len(avi_data['movi']['frame_data']['frame_data'])}, new frame count: {new_frame_count}")
-    struct.pack_into('<I', new_file_data, 16, new_frame_count)
-    
-
-    with open(output_filename, "wb") as f_out:
-        f_out.write(new_file_data)
+    start_at = as_frame_list(start_at)
+    end_at = as_frame_list(end_at)
+    transition_frames = transition_frames or []
+    # Reuse the mapping of the parsed index rather than reading the file again
+    owns_index = not isinstance(avi_data, AviIndex)
+    index = extract_avi_data(input_filename) if owns_index else avi_data
+    try:
+        plan = compile_mosh_plan(index.frames, start_at, end_at, transition_frames, duplicated_p_frames, alias_duplicates)
+        for start, end in merge_windows(start_at, end_at):
+            print(f"removing I-frames from frame {start} to {end}...")
+        stats = {"frames": plan.output_frame_count, "swapped": plan.swapped_count, "dropped": plan.dropped_count, "bytes_read": 0, "bytes_written": 0}
+        previous = load_cached_plan(index.filename, output_filename)
+        if previous == plan:
+            print(f"#### Datamosh plan unchanged, keeping: {output_filename}")
+            return stats
+        if previous is not None:
+            print(f"    plan changed for frames: {previous.diff(plan)}")
+        # Frames are streamed straight to disk, untouched runs are copied as one span
+        writer = write_mosh_plan(index, plan, output_filename, previous, progress, checkpoint_interval, on_checkpoint)
+        save_cached_plan(index.filename, output_filename, plan)
+        stats["bytes_read"] = writer.bytes_read
+        stats["bytes_written"] = writer.bytes_written
+    finally:
+        if owns_index:
+            index.close()
+
+    print(f"Old frame count: {index.frame_count}, new frame count: {writer.frame_count}")
+    print(f"    swapped {stats['swapped']} I-frames, dropped {stats['dropped']} frames")
     print(f"#### Datamosh complete. Saved to: {output_filename}")
+    return stats
 
-if __name__ == "__main__":
-    # Example usage
-    convert_to_avi("test.mp4", "temp.avi", compression=15)
-    input_file = "temp.avi"
-    output_file = "output_glitched.avi"
-    avi_data = extract_avi_data(input_file)
-    create_datamoshed_avi(avi_data, input_file, output_file, start_at=[143,275,545,673], end_at=[243,325,665,723], duplicated_p_frames=0, transition_frames=[153,285,555,683])
\ No newline at end of file
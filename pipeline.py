@@ -0,0 +1,306 @@
+#############################################################################
+# Datamosh addon for blender                                                #
+# Copyright (C) 2025 Dan Argust                                             #
+#                                                                           #
+#    This program is free software: you can redistribute it and/or modify   #
+#    it under the terms of the GNU General Public License as published by   #
+#    the Free Software Foundation, either version 3 of the License, or      #
+#    (at your option) any later version.                                    #
+#                                                                           #
+#    This program is distributed in the hope that it will be useful,        #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of         #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the          #
+#    GNU General Public License for more details.                           #
+#                                                                           #
+#    You should have received a copy of the GNU General Public License      #
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>. #
+#############################################################################
+
+import os
+import queue
+import threading
+import time
+import traceback
+try:
+    from .parse_raw_avi import convert_to_avi, extract_avi_data, create_datamoshed_avi, create_datamoshed_avis, sidecar_path
+    from .mosh_plan import merge_windows, plan_cache_files
+    from .avi_cache import cache_key
+    from .instrumentation import RunStats
+    from .scene_cuts import detect_scene_cuts
+except ImportError:
+    from parse_raw_avi import convert_to_avi, extract_avi_data, create_datamoshed_avi, create_datamoshed_avis, sidecar_path
+    from mosh_plan import merge_windows, plan_cache_files
+    from avi_cache import cache_key
+    from instrumentation import RunStats
+    from scene_cuts import detect_scene_cuts
+
+class Cancelled(Exception):
+    """Raised inside the worker once the job has been cancelled."""
+
+class DatamoshJob:
+    """Runs the convert/extract/mosh steps on a worker thread.
+
+    The worker never touches bpy. It posts ("progress", stage, fraction),
+    ("done", outputs), ("cancelled", None) or ("error", message) tuples
+    to a queue which the caller drains with poll(). outputs is a list of
+    (filename, first_frame) pairs, first_frame being the frame of the
+    render where that file starts.
+
+    With windows_only set, only the frames of each mosh window are cut out
+    of the render, converted and moshed, giving one short clip per window
+    instead of a full-length file. fps is needed to seek to the windows.
+
+    Given a ConversionCache, converted AVIs are looked up in and kept in the
+    cache instead of being converted on every run and deleted afterwards.
+
+    With scale set the render is converted to a downsized proxy first, even
+    an AVI one, for a quick preview of the same parameters.
+
+    variants is an optional list of dicts with their own output file and
+    start_points, end_points, transition_frames and duplicated_p_frames.
+    They are all written in one pass over the converted render, each giving
+    an output starting at frame 0. Windowed runs ignore the variants.
+
+    alias_duplicates stores each duplicated P-frame once and repeats only
+    its index entries, see create_datamoshed_avi.
+
+    With checkpoint_interval the output of a full-length, single output run
+    is made playable every so many seconds while it is written, each time
+    posting ("checkpoint", filename, frame_count, shown) so it can be shown
+    early. shown is a threading.Event the caller sets once it has reopened
+    the file; the worker waits for it, as carrying on would overwrite the
+    index the file was made playable with.
+
+    Every stage is measured into stats (a RunStats), which is complete once
+    the final message has been posted and is also written to report_file
+    as JSON if one is given.
+    """
+
+    # Shown by the panel while the job runs
+    title = "Datamoshing"
+
+    def __init__(self, input_file, output_file, start_points, end_points, transition_frames, duplicated_p_frames=0, compression=3, total_frames=None, workers=1, windows_only=False, fps=None, cache=None, trace_memory=False, report_file=None, scale=None, variants=None, alias_duplicates=False, checkpoint_interval=None):
+        self.input_file = input_file
+        self.output_file = output_file
+        self.start_points = start_points
+        self.end_points = end_points
+        self.transition_frames = transition_frames
+        self.duplicated_p_frames = duplicated_p_frames
+        self.alias_duplicates = alias_duplicates
+        self.checkpoint_interval = checkpoint_interval
+        self.compression = compression
+        self.total_frames = total_frames
+        self.workers = workers
+        self.cache = cache
+        self.scale = scale
+        self.variants = variants if variants and not windows_only else None
+        # AVI renders are moshed directly unless previewing, anything else goes through ffmpeg first
+        self.convert = not input_file.lower().endswith(".avi") or scale is not None
+        suffix = "_preview_temp.avi" if scale is not None else "_temp.avi"
+        self.temp_file = os.path.splitext(input_file)[0] + suffix if self.convert else input_file
+        # An AVI render needs no conversion, so there is nothing to save by cutting it up
+        self.windows = merge_windows(start_points, end_points) if windows_only and self.convert else None
+        self.fps = fps
+        if self.windows is not None:
+            self.stages = [f"{stage} {q + 1}/{len(self.windows)}" for q in range(len(self.windows)) for stage in ("convert", "extract", "mosh")]
+        else:
+            self.stages = ["convert", "extract", "mosh"] if self.convert else ["extract", "mosh"]
+        self.stats = RunStats(trace_memory)
+        self.report_file = report_file
+        self.stage = None
+        self.progress = 0.0
+        self.eta = None
+        self._stage_started = None
+        self.messages = queue.Queue()
+        self._cancel = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name="datamosh", daemon=True)
+        self._thread.start()
+
+    def cancel(self):
+        self._cancel.set()
+
+    def poll(self):
+        messages = []
+        while True:
+            try:
+                messages.append(self.messages.get_nowait())
+            except queue.Empty:
+                return messages
+
+    def begin_stage(self, stage):
+        self.stats.begin(stage)
+        self.stage = stage
+        self.eta = None
+        self._stage_started = time.monotonic()
+        self.report(0.0)
+
+    def report(self, fraction):
+        if self._cancel.is_set():
+            raise Cancelled()
+        if 0.0 < fraction < 1.0:
+            # Seconds left in the current stage at the rate seen so far
+            self.eta = (time.monotonic() - self._stage_started) * (1.0 - fraction) / fraction
+        progress = (self.stages.index(self.stage) + min(fraction, 1.0)) / len(self.stages)
+        # Only post visible changes, the writer reports after every span
+        if progress == 0.0 or progress - self.progress >= 0.001:
+            self.progress = progress
+            self.messages.put(("progress", self.stage, progress))
+
+    def run(self):
+        result = ("error", "Datamosh did not finish")
+        try:
+            if self.windows is not None:
+                outputs = [self.run_window(q, start, end) for q, (start, end) in enumerate(self.windows)]
+            else:
+                outputs = self.run_full()
+            result = ("done", outputs)
+        except Cancelled:
+            result = ("cancelled", None)
+        except Exception as e:
+            traceback.print_exc()
+            result = ("error", str(e))
+        finally:
+            self.finish_stats()
+            self.messages.put(result)
+
+    def post_checkpoint(self, frame_count):
+        shown = threading.Event()
+        self.messages.put(("checkpoint", self.output_file, frame_count, shown))
+        while not shown.wait(0.1):
+            if self._cancel.is_set():
+                raise Cancelled()
+
+    def finish_stats(self):
+        self.stats.close()
+        for stage in self.stats.stages:
+            for line in self.stats.describe(stage):
+                print(line)
+        print(self.stats.summary())
+        if self.report_file:
+            try:
+                self.stats.save(self.report_file)
+                print(f"Saved datamosh report: {self.report_file}")
+            except OSError as e:
+                print(f"Could not write datamosh report: {e}")
+
+    def run_full(self):
+        index = None
+        temp_file = self.temp_file
+        try:
+            if self.convert:
+                self.begin_stage("convert")
+                temp_file = self.convert_step(self.temp_file, total_frames=self.total_frames, workers=self.workers)
+            self.begin_stage("extract")
+            print(f"Extracting AVI data: {temp_file}")
+            index = extract_avi_data(temp_file, progress=self.report)
+            self.stats.add(bytes_read=index.bytes_read, frames=index.frame_count)
+            self.begin_stage("mosh")
+            if self.variants:
+                print(f"Creating {len(self.variants)} datamoshed AVIs")
+                variants = [{"output": v["output_file"], "start_at": v["start_points"], "end_at": v["end_points"], "transition_frames": v["transition_frames"], "duplicated_p_frames": v["duplicated_p_frames"], "alias_duplicates": self.alias_duplicates} for v in self.variants]
+                stats = create_datamoshed_avis(index, variants, progress=self.report)
+                del stats["variants"]
+                self.stats.add(**stats)
+            else:
+                print(f"Creating datamoshed AVI: {self.output_file}")
+                self.stats.add(**create_datamoshed_avi(index, temp_file, self.output_file, start_at=self.start_points, end_at=self.end_points, duplicated_p_frames=self.duplicated_p_frames, transition_frames=self.transition_frames, progress=self.report, alias_duplicates=self.alias_duplicates, checkpoint_interval=self.checkpoint_interval, on_checkpoint=self.post_checkpoint))
+        finally:
+            # Release the mapping so the temp file can be removed (required on Windows)
+            if index is not None:
+                index.close()
+            if self.convert and self.cache is None:
+                self.cleanup_temp_files(temp_file)
+        if self.variants:
+            return [(v["output_file"], 0) for v in self.variants]
+        return [(self.output_file, 0)]
+
+    def convert_step(self, temp_file, total_frames=None, workers=1, start_frame=0, frame_count=None):
+        """Convert the input to temp_file, or to/from the cache if there is one. Returns the AVI to use."""
+        if self.cache is not None:
+            settings = {"compression": self.compression, "start_frame": start_frame, "frame_count": frame_count}
+            if self.scale is not None:
+                settings["scale"] = self.scale
+            key = cache_key(self.input_file, **settings)
+            cached = self.cache.lookup(key)
+            if cached is not None:
+                print(f"Using cached conversion: {cached}")
+                return cached
+            temp_file = self.cache.partial_path(key)
+        print(f"Converting to AVI: {self.input_file}")
+        convert_to_avi(self.input_file, temp_file, self.compression, progress=self.report, total_frames=total_frames, workers=workers, start_frame=start_frame, frame_count=frame_count, fps=self.fps, scale=self.scale)
+        # ffmpeg's own reads are not visible from here, count the whole input
+        self.stats.add(bytes_read=os.path.getsize(self.input_file), bytes_written=os.path.getsize(temp_file), frames=total_frames or 0)
+        if self.cache is not None:
+            temp_file = self.cache.store(key, temp_file)
+        return temp_file
+
+    def run_window(self, q, start, end):
+        """Convert and mosh only frames start..end of the render."""
+        base = os.path.splitext(self.output_file)[0]
+        temp_file = f"{os.path.splitext(self.temp_file)[0]}_{start}.avi"
+        output_file = f"{base}_{start}.avi"
+        frame_count = end - start + 1
+        transitions = [frame - start for frame in self.transition_frames if start <= frame <= end]
+        label = f"{q + 1}/{len(self.windows)}"
+        index = None
+        try:
+            self.begin_stage(f"convert {label}")
+            print(f"Converting frames {start} to {end}")
+            temp_file = self.convert_step(temp_file, total_frames=frame_count, start_frame=start, frame_count=frame_count)
+            self.begin_stage(f"extract {label}")
+            index = extract_avi_data(temp_file, progress=self.report)
+            self.stats.add(bytes_read=index.bytes_read, frames=index.frame_count)
+            self.begin_stage(f"mosh {label}")
+            print(f"Creating datamoshed AVI: {output_file}")
+            self.stats.add(**create_datamoshed_avi(index, temp_file, output_file, start_at=[0], end_at=[index.frame_count - 1], duplicated_p_frames=self.duplicated_p_frames, transition_frames=transitions, progress=self.report, alias_duplicates=self.alias_duplicates))
+        finally:
+            if index is not None:
+                index.close()
+            if self.cache is None:
+                self.cleanup_temp_files(temp_file)
+        return output_file, start
+
+    def cleanup_temp_files(self, temp_file):
+        print(f"Cleaning up temp files: {temp_file}")
+        for filename in [temp_file, sidecar_path(temp_file)] + plan_cache_files(temp_file):
+            if os.path.exists(filename):
+                os.remove(filename)
+
+class CutDetectionJob(DatamoshJob):
+    """Converts the render like DatamoshJob, then detects its scene cuts instead of moshing.
+
+    Posts ("done", cuts) with the sorted frames of the cuts. Conversions are
+    shared with DatamoshJob through the cache.
+    """
+
+    title = "Detecting cuts"
+
+    def __init__(self, input_file, compression=3, total_frames=None, workers=1, cache=None):
+        super().__init__(input_file, None, [], [], [], compression=compression, total_frames=total_frames, workers=workers, cache=cache)
+        self.stages = ["convert", "extract"] if self.convert else ["extract"]
+
+    def run_full(self):
+        index = None
+        temp_file = self.temp_file
+        try:
+            if self.convert:
+                self.begin_stage("convert")
+                temp_file = self.convert_step(self.temp_file, total_frames=self.total_frames, workers=self.workers)
+            self.begin_stage("extract")
+            index = extract_avi_data(temp_file, progress=self.report)
+            self.stats.add(bytes_read=index.bytes_read, frames=index.frame_count)
+            cuts = detect_scene_cuts(index.frames)
+        finally:
+            if index is not None:
+                index.close()
+            if self.convert and self.cache is None:
+                self.cleanup_temp_files(temp_file)
+        print(f"Detected {len(cuts)} scene cuts in {temp_file}")
+        return cuts
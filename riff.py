@@ -0,0 +1,70 @@
+#############################################################################
+# Datamosh addon for blender                                                #
+# Copyright (C) 2025 Dan Argust                                             #
+#                                                                           #
+#    This program is free software: you can redistribute it and/or modify   #
+#    it under the terms of the GNU General Public License as published by   #
+#    the Free Software Foundation, either version 3 of the License, or      #
+#    (at your option) any later version.                                    #
+#                                                                           #
+#    This program is distributed in the hope that it will be useful,        #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of         #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the          #
+#    GNU General Public License for more details.                           #
+#                                                                           #
+#    You should have received a copy of the GNU General Public License      #
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>. #
+#############################################################################
+
+
+from collections import namedtuple
+import struct
+
+CHUNK_HEADER = struct.Struct("<4sI")
+LIST_FOURCCS = (b"RIFF", b"LIST")
+
+class Chunk(namedtuple("Chunk", "fourcc list_type start size depth")):
+    """Header of one RIFF chunk: its fourcc, the list type of a RIFF/LIST
+    (None for other chunks), the offset of its header, its declared payload
+    size and how many lists it is nested in."""
+    __slots__ = ()
+
+    @property
+    def end(self):
+        """Offset of the next chunk, including the pad byte of an odd size."""
+        return self.start + 8 + self.size + (self.size & 1)
+
+def walk_chunks(data, start=0, end=None, max_depth=None, skip=(), depth=0):
+    """Yield the chunks of data[start:end] in file order, lists before their contents.
+
+    Each step hops from one header to the next by the declared size, so no
+    payload is looked at and the cost is one step per chunk. RIFF and LIST
+    chunks are entered unless their list type is in skip or they are at
+    max_depth. Sizes running past the end (a truncated file, or the 0 of a
+    RIFF or LIST whose writer never finished) are cut off at end.
+
+    data is anything sliceable, e.g. bytes or an mmap.
+    """
+    if end is None:
+        end = len(data)
+    pos = start
+    while pos + 8 <= end:
+        fourcc, size = CHUNK_HEADER.unpack(data[pos:pos + 8])
+        if fourcc in LIST_FOURCCS and pos + 12 <= end:
+            list_type = bytes(data[pos + 8:pos + 12])
+            if size == 0:
+                size = end - pos - 8
+            chunk = Chunk(fourcc, list_type, pos, size, depth)
+            yield chunk
+            if list_type not in skip and (max_depth is None or depth < max_depth):
+                yield from walk_chunks(data, pos + 12, min(pos + 8 + size, end), max_depth, skip, depth + 1)
+        else:
+            yield Chunk(fourcc, None, pos, size, depth)
+        pos += 8 + size + (size & 1)
+
+def find_chunk(data, fourcc, start=0, end=None, list_type=None, max_depth=None, skip=()):
+    """First chunk with this fourcc (and list type) in data[start:end], None if there is none."""
+    for chunk in walk_chunks(data, start, end, max_depth, skip):
+        if chunk.fourcc == fourcc and (list_type is None or chunk.list_type == list_type):
+            return chunk
+    return None
@@ -0,0 +1,82 @@
+#############################################################################
+# Datamosh addon for blender                                                #
+# Copyright (C) 2025 Dan Argust                                             #
+#                                                                           #
+#    This program is free software: you can redistribute it and/or modify   #
+#    it under the terms of the GNU General Public License as published by   #
+#    the Free Software Foundation, either version 3 of the License, or      #
+#    (at your option) any later version.                                    #
+#                                                                           #
+#    This program is distributed in the hope that it will be useful,        #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of         #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the          #
+#    GNU General Public License for more details.                           #
+#                                                                           #
+#    You should have received a copy of the GNU General Public License      #
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>. #
+#############################################################################
+
+
+from itertools import accumulate
+try:
+    from .avi_writer import AVIIF_KEYFRAME
+    from .frame_table import VopType
+except ImportError:
+    from avi_writer import AVIIF_KEYFRAME
+    from frame_table import VopType
+
+# Frames moshed before and after each transition by default
+FRAMES_BEFORE = 10
+FRAMES_AFTER = 60
+
+def keyframe_positions(frames):
+    """Sorted indices of the frames that are keyframes by VOP type or by their index flags."""
+    keys = set(frames.positions(VopType.I))
+    flags = frames.flags
+    keys.update(i for i in range(len(flags)) if flags[i] & AVIIF_KEYFRAME)
+    return sorted(keys)
+
+def detect_scene_cuts(frames, spike_ratio=4.0, window=24, min_spacing=12):
+    """Likely scene cuts in a parsed frame table, found without decoding anything.
+
+    Xvid never leaves more than its maximum key interval between keyframes,
+    so the longest gap seen is taken as the regular interval and a keyframe
+    that comes sooner was placed by its scene change detection. Cuts it
+    coded as P-frames show up as P-frames more than spike_ratio times the
+    mean of the P-frames in the preceding window. Cuts closer than
+    min_spacing to the previous one are dropped.
+    """
+    cuts = []
+    keys = keyframe_positions(frames)
+    if len(keys) > 1:
+        interval = max(b - a for a, b in zip(keys, keys[1:]))
+        cuts += [b for a, b in zip(keys, keys[1:]) if b - a < interval]
+
+    # Running totals of P-frame sizes and counts give every window mean in O(1)
+    sizes = frames.sizes
+    is_p = [t == VopType.P for t in frames.types]
+    p_totals = [0] + list(accumulate(size if p else 0 for size, p in zip(sizes, is_p)))
+    p_counts = [0] + list(accumulate(is_p))
+    min_count = max(window // 4, 1)
+    for i in frames.positions(VopType.P):
+        lo = max(i - window, 0)
+        count = p_counts[i] - p_counts[lo]
+        if count >= min_count and sizes[i] * count > spike_ratio * (p_totals[i] - p_totals[lo]):
+            cuts.append(i)
+
+    spaced = []
+    for cut in sorted(set(cuts)):
+        if not spaced or cut - spaced[-1] >= min_spacing:
+            spaced.append(cut)
+    return spaced
+
+def propose_mosh_points(transition_frames, frame_count=None, before=FRAMES_BEFORE, after=FRAMES_AFTER, skip_early=True):
+    """Transition, start and end points moshing each transition from before frames ahead to after frames past it.
+
+    Transitions too close to the start for a full lead-in are skipped, or
+    with skip_early off moshed from frame 0.
+    """
+    transitions = [frame for frame in transition_frames if not skip_early or frame >= before + 2]
+    start_points = [max(frame - before, 0) for frame in transitions]
+    end_points = [frame + after if frame_count is None else min(frame + after, frame_count - 1) for frame in transitions]
+    return transitions, start_points, end_points
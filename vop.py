@@ -0,0 +1,143 @@
+#############################################################################
+# Datamosh addon for blender                                                #
+# Copyright (C) 2025 Dan Argust                                             #
+#                                                                           #
+#    This program is free software: you can redistribute it and/or modify   #
+#    it under the terms of the GNU General Public License as published by   #
+#    the Free Software Foundation, either version 3 of the License, or      #
+#    (at your option) any later version.                                    #
+#                                                                           #
+#    This program is distributed in the hope that it will be useful,        #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of         #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the          #
+#    GNU General Public License for more details.                           #
+#                                                                           #
+#    You should have received a copy of the GNU General Public License      #
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>. #
+#############################################################################
+
+
+from functools import lru_cache
+try:
+    from .frame_table import VopType
+except ImportError:
+    from frame_table import VopType
+
+START_CODE = b"\x00\x00\x01"
+VOP_START = START_CODE + b"\xb6"
+# video_object_layer_start_code is 0x20..0x2f
+VOL_CODES = range(0x20, 0x30)
+
+# Chunks without a VOP up to this size are the stuffing placeholders of
+# packed bitstreams, larger ones are something we can't read
+PLACEHOLDER_SIZE = 8
+
+class BitReader:
+    """Big-endian bit fields of a short byte string."""
+
+    def __init__(self, data):
+        self.value = int.from_bytes(data, "big")
+        self.bits = len(data) * 8
+        self.pos = 0
+
+    def read(self, count):
+        if self.pos + count > self.bits:
+            raise ValueError("Header runs past the end of the data")
+        self.pos += count
+        return (self.value >> (self.bits - self.pos)) & ((1 << count) - 1)
+
+# Encoders repeat the same VOL ahead of every keyframe
+@lru_cache(maxsize=16)
+def vop_time_increment_bits(vol):
+    """Width of vop_time_increment given the bytes of a VOL header after its start code, None if unreadable."""
+    bits = BitReader(vol[:32])
+    try:
+        bits.read(1)  # random_accessible_vol
+        bits.read(8)  # video_object_type_indication
+        verid = 1
+        if bits.read(1):  # is_object_layer_identifier
+            verid = bits.read(4)
+            bits.read(3)
+        if bits.read(4) == 15:  # aspect_ratio_info, extended PAR
+            bits.read(16)
+        if bits.read(1):  # vol_control_parameters
+            bits.read(3)  # chroma_format, low_delay
+            if bits.read(1):  # vbv_parameters
+                bits.read(79)
+        shape = bits.read(2)
+        if shape == 3 and verid != 1:
+            bits.read(4)  # video_object_layer_shape_extension
+        bits.read(1)  # marker
+        resolution = bits.read(16)
+    except ValueError:
+        return None
+    return max((resolution - 1).bit_length(), 1) if resolution else None
+
+def find_vol_time_bits(data, start, end):
+    """vop_time_increment width of the first VOL header in data[start:end], None if there is none."""
+    pos = data.find(START_CODE, start, end)
+    while pos != -1 and pos + 4 <= end:
+        if data[pos + 3] in VOL_CODES:
+            return vop_time_increment_bits(bytes(data[pos + 4:min(pos + 36, end)]))
+        pos = data.find(START_CODE, pos + 3, end)
+    return None
+
+# vop_coding_type values in order
+CODING_TYPES = (VopType.I, VopType.P, VopType.B, VopType.S)
+
+def decode_vop(header, time_bits=None):
+    """VopType of a VOP given the bytes after its start code.
+
+    vop_coding_type is the first two bits. Telling an N-VOP from the type
+    it claims to be needs vop_coded, which follows the time stamp and so
+    needs time_bits from the VOL; without it the coding type is returned.
+    Called for every frame, so the bits are picked out of one integer.
+    """
+    if not header:
+        return VopType.UNKNOWN
+    coding_type = CODING_TYPES[header[0] >> 6]
+    if time_bits is None:
+        return coding_type
+    header = header[:8]
+    bits = len(header) * 8
+    value = int.from_bytes(header, "big")
+    pos = 2
+    # modulo_time_base is a run of ones ended by a zero
+    while pos < bits and value >> (bits - 1 - pos) & 1:
+        pos += 1
+    # Past that zero, a marker, vop_time_increment and another marker is vop_coded
+    pos += 1 + 1 + time_bits + 1
+    if pos >= bits:
+        return coding_type
+    return coding_type if value >> (bits - 1 - pos) & 1 else VopType.N
+
+def classify_vops(data, frames, first=0, extradata=b""):
+    """VopType codes of frames first.. of a FrameTable, as a bytearray.
+
+    One pass in frame order over the (mapped) file. Each frame is typed by
+    its first VOP, wherever it starts in the chunk, which is the reference
+    frame of a packed bitstream chunk holding a P- and a B-VOP. The VOL
+    headers passed on the way (or in the strf extradata) give the field
+    widths needed to spot N-VOPs.
+    """
+    time_bits = find_vol_time_bits(extradata, 0, len(extradata))
+    if time_bits is None and first:
+        # Picking up after frames that were typed earlier, their last keyframe has the VOL
+        key = frames.previous(VopType.I, first)
+        if key is not None:
+            key_start = frames.starts[key] + 8
+            time_bits = find_vol_time_bits(data, key_start, key_start + frames.sizes[key])
+    types = bytearray()
+    starts, sizes = frames.starts, frames.sizes
+    for i in range(first, len(starts)):
+        start = starts[i] + 8
+        end = start + sizes[i]
+        vop = data.find(VOP_START, start, end)
+        if vop == -1:
+            types.append(VopType.N if sizes[i] <= PLACEHOLDER_SIZE else VopType.UNKNOWN)
+            continue
+        if vop > start:
+            # VOS, VOL, GOV and user data headers come ahead of a keyframe's VOP
+            time_bits = find_vol_time_bits(data, start, vop) or time_bits
+        types.append(decode_vop(data[vop + 4:min(vop + 12, end)], time_bits))
+    return types